@@ -1,7 +1,7 @@
 from flask import current_app, Blueprint, render_template, session, request, redirect, send_from_directory, flash
-from database_modules import database_module, language_module, moderation_module
+from database_modules import database_module, language_module, moderation_module, captcha_module
+from blueprints import request_context
 from database_modules.moderation_module import (
-    resolve_user_identifier,
     get_current_anonymous_mode,
     is_force_captcha_anonymous_enabled,
     ANONYMOUS_MODE_OPTIONS,
@@ -30,7 +30,7 @@ def has_admin_perms(f):
             flash(lang["flash-login-required"], 'danger')
             return redirect(request.referrer or '/')
 
-        roles = database_module.get_user_role(username)
+        roles = request_context.user_role(username)
         if not roles or ('owner' not in roles.lower() and 'mod' not in roles.lower()):
             lang = get_lang()
             flash(lang["flash-not-enough-permissions"], 'danger')
@@ -47,7 +47,7 @@ def has_owner_perms(f):
             flash(lang["flash-login-required"], 'danger')
             return redirect(request.referrer or '/')
 
-        roles = database_module.get_user_role(username)
+        roles = request_context.user_role(username)
         if not roles or 'owner' not in roles.lower():
             lang = get_lang()
             flash(lang["flash-not-enough-permissions"], 'danger')
@@ -66,14 +66,8 @@ def has_board_owner_or_admin_perms(get_board_uri_from_request):
                 flash(lang["flash-login-required"], 'danger')
                 return redirect(request.referrer or '/')
 
-            roles = database_module.get_user_role(username)
-            is_admin = roles and ('owner' in roles.lower() or 'mod' in roles.lower())
-
             board_uri = get_board_uri_from_request(*args, **kwargs)
-            board_owner = database_module.get_board_info(board_uri).get('board_owner')
-            board_staffs = database_module.get_board_info(board_uri).get('board_staffs')
-
-            if is_admin or username == board_owner or username in board_staffs:
+            if request_context.board_permissions(board_uri)['is_privileged']:
                 return f(*args, **kwargs)
             lang = get_lang()
             flash(lang["flash-no-permission"], 'danger')
@@ -99,7 +93,7 @@ def has_post_permission_or_same_ip(get_post_id_from_request):
             poster_ip = database_module.get_post_ip(int(post_id))
             
             # Get current user's effective identifier
-            current_user_ip, _ = resolve_user_identifier(request, session)
+            current_user_ip = request_context.viewer_identifier()
 
             # Check if same identifier - this works even for non-logged users
             if current_user_ip and poster_ip and current_user_ip == poster_ip:
@@ -113,7 +107,7 @@ def has_post_permission_or_same_ip(get_post_id_from_request):
                 return redirect(request.referrer or '/')
             
             # Check global admin permissions
-            roles = database_module.get_user_role(username)
+            roles = request_context.user_role(username)
             is_global_mod = roles and ('owner' in roles.lower() or 'mod' in roles.lower())
             
             if is_global_mod:
@@ -161,10 +155,28 @@ def allowed_file(file_storage):
 
 @auth_bp.route('/api/refresh_captcha', methods=['GET'])
 def refresh_captcha():
-    text, image = database_module.generate_captcha()
-    session['captcha_text'] = text
+    image, captcha_hash = captcha_module.take_captcha()
+    session['captcha_text'] = captcha_hash
     return {'captcha_image': image}
 
+@auth_bp.route('/api/captcha/<nonce>.<image_format>', methods=['GET'])
+def captcha_image(nonce, image_format):
+    # Only the challenge this session was issued, so arbitrary nonces cannot be rendered.
+    if nonce != database_module.captcha_token_nonce(session.get('captcha_text')):
+        return {'error': 'Captcha not found'}, 404
+    image = captcha_module.captcha_image(nonce, image_format)
+    if image is None:
+        return {'error': 'Captcha not found'}, 404
+    return image, 200, {
+        'Content-Type': captcha_module.IMAGE_FORMATS[image_format],
+        'Cache-Control': f'private, max-age={database_module.CAPTCHA_TOKEN_TTL}'
+    }
+
+@auth_bp.route('/api/captcha_metrics', methods=['GET'])
+@has_admin_perms
+def captcha_metrics():
+    return captcha_module.pool_metrics()
+
 @auth_bp.route('/api/get_post_info', methods=['GET'])
 def get_post_info():
     post_id = request.args.get('post_id')
@@ -416,7 +428,7 @@ def lock_thread(post_id):
 @has_board_owner_or_admin_perms(lambda board_uri: board_uri)
 def remove_board(board_uri):
     name = session["username"]
-    roles = database_module.get_user_role(name)
+    roles = request_context.user_role(name)
     lang = get_lang()
     if database_module.remove_board(board_uri, name, roles):
         flash(lang["flash-board-deleted"])
@@ -505,7 +517,7 @@ def resolve_report(report_id):
     board_uri = report['board']
     
     # Check permissions
-    roles = database_module.get_user_role(username)
+    roles = request_context.user_role(username)
     is_admin = roles and ('owner' in roles.lower() or 'mod' in roles.lower())
     
     board = database_module.get_board_info(board_uri)
@@ -707,7 +719,7 @@ def remove_ban(ban_id):
         return redirect('/conta')
 
     username = session['username']
-    roles = database_module.get_user_role(username)
+    roles = request_context.user_role(username)
     roles_lower = roles.lower() if roles else ''
 
     ban_manager = moderation_module.BanManager()
@@ -732,14 +744,7 @@ def remove_ban(ban_id):
         flash('You do not have permission to remove this ban.', 'danger')
         return redirect(request.referrer or '/')
 
-    all_boards = database_module.get_all_boards(include_stats=True)
-    user_board_uris = set()
-    for board in all_boards:
-        board_uri = board.get('board_uri')
-        if not board_uri:
-            continue
-        if board.get('board_owner') == username or username in board.get('board_staffs', []):
-            user_board_uris.add(board_uri)
+    user_board_uris = request_context.user_acl(username)['boards']
 
     if not user_board_uris or not set(boards).issubset(user_board_uris):
         lang = get_lang()
@@ -757,7 +762,7 @@ def login():
     password = request.form['password']
     if database_module.login_user(username, password):
         session['username'] = username
-        session['role'] = database_module.get_user_role(username)
+        session['role'] = database_module.get_user_role(username)  # fresh login, not memoized
         return redirect('/conta')
     lang = get_lang()
     flash(lang["flash-invalid-credentials"], 'danger')
@@ -788,7 +793,7 @@ def create_board():
              flash(lang["flash-login-required-create-board"], 'danger')
              return redirect(request.referrer or '/')
              
-        roles = database_module.get_user_role(username)
+        roles = request_context.user_role(username)
         if not roles or ('owner' not in roles.lower() and 'mod' not in roles.lower()):
             flash(lang["flash-board-creation-disabled"], 'danger')
             return redirect(request.referrer or '/')
@@ -939,14 +944,7 @@ def delete_banner():
     if not board_info:
         return redirect(request.referrer)
         
-    roles = database_module.get_user_role(username)
-    user_roles = roles.lower() if roles else ''
-    
-    is_moderator = 'mod' in user_roles or 'owner' in user_roles
-    is_board_staff = username in board_info.get('board_staffs', [])
-    is_board_owner = username == board_info.get('board_owner')
-    
-    if is_board_owner or is_moderator or is_board_staff:
+    if request_context.board_permissions(board_uri, username)['is_privileged']:
         lang = get_lang()
         if database_module.delete_board_banner(board_uri, banner_filename):
             flash(lang["flash-banner-deleted"])
@@ -1,11 +1,12 @@
 #imports
 from flask import current_app, Blueprint, render_template, session, redirect, request, url_for, flash, send_from_directory
 from flask_wtf.csrf import generate_csrf
-from database_modules import database_module, language_module
+from database_modules import database_module, language_module, captcha_module, thumbnail_module
 from database_modules.moderation_module import (
     TimeoutManager, BanManager, ReportManager, ChanConfigManager, WordFilterManager,
-    resolve_user_identifier, should_force_captcha_for_identifier
+    should_force_captcha_for_identifier
 )
+from blueprints import request_context
 import os
 import pytz
 #blueprint register.
@@ -40,6 +41,10 @@ def get_chan_config():
 def globalboards():
     boards = database_module.get_all_boards(include_stats=True)
     return {"boards": boards}
+#image thumbnails for board and catalog pages.
+@boards_bp.context_processor
+def inject_thumbnail():
+    return dict(thumbnail=thumbnail_module.thumbnail)
 #load custom themes
 @boards_bp.context_processor
 def customthemes():
@@ -49,12 +54,12 @@ def customthemes():
 @boards_bp.context_processor
 def inject_current_user_identifier():
     try:
-        identifier, _ = resolve_user_identifier(request, session)
+        identifier = request_context.viewer_identifier()
     except Exception:
         identifier = getattr(request, 'remote_addr', None) or ''
     return dict(current_user_identifier=identifier)
 
-def mark_banned_flags(records, board_uri, ban_manager):
+def mark_banned_flags(records, board_uri):
     if not records:
         return
     for record in records:
@@ -62,7 +67,7 @@ def mark_banned_flags(records, board_uri, ban_manager):
         user_ip = record.get('user_ip')
         if not user_ip:
             continue
-        status = ban_manager.is_banned(user_ip)
+        status = request_context.ban_status(user_ip)
         if not status.get('is_banned'):
             continue
         boards = status.get('boards')
@@ -86,11 +91,11 @@ def main_page():
     if sidebar_enabled == 1:
         return render_template('frameset.html')
 
-    posts = database_module.get_all_posts()
+    posts = database_module.get_all_posts(limit=6)
     return render_template(
         'index.html',
         all_posts=posts,
-        posts=reversed(posts[-6:]),
+        posts=posts,
         news=chan_config.get('index_news', 'No news to display'),
         lang=language_module.get_user_lang('default')
     )
@@ -100,8 +105,8 @@ def main_page():
 def home_page():
     config_manager = ChanConfigManager()
     chan_config = config_manager.get_config()
-    posts = database_module.get_all_posts()
-    return render_template('index.html',all_posts=posts,posts=reversed(posts[-6:]), news=chan_config['index_news'], lang=language_module.get_user_lang('default'))
+    posts = database_module.get_all_posts(limit=6)
+    return render_template('index.html',all_posts=posts,posts=posts, news=chan_config['index_news'], lang=language_module.get_user_lang('default'))
 
 #sidebar route.
 @boards_bp.route('/pages/sidebar.html')
@@ -119,7 +124,7 @@ def login():
         username = session["username"]
         user_boards = database_module.get_user_boards(username)
         all_boards = database_module.get_all_boards(include_stats=True)
-        roles = database_module.get_user_role(username)
+        roles = request_context.user_role(username)
         roles_lower = roles.lower() if roles else ''
         
         # Extended data for dashboard
@@ -132,13 +137,7 @@ def login():
         active_timeouts = timeout_manager.get_active_timeouts()
         all_active_bans = ban_manager.get_active_bans()
 
-        user_board_uris = set()
-        for board in all_boards:
-            board_uri = board.get('board_uri')
-            if not board_uri:
-                continue
-            if board.get('board_owner') == username or username in board.get('board_staffs', []):
-                user_board_uris.add(board_uri)
+        user_board_uris = request_context.user_acl(username)['boards']
 
         is_global_admin = 'owner' in roles_lower or 'mod' in roles_lower
 
@@ -224,7 +223,7 @@ def users_dashboard():
         return redirect('/conta')
         
     username = session["username"]
-    roles = database_module.get_user_role(username)
+    roles = request_context.user_role(username)
     
     # Check permissions (Owner or Mod)
     if not roles or ('owner' not in roles.lower() and 'mod' not in roles.lower()):
@@ -259,7 +258,7 @@ def word_filters_page():
     if 'username' not in session:
         return redirect('/conta')
     username = session["username"]
-    roles = database_module.get_user_role(username)
+    roles = request_context.user_role(username)
     if not roles or ('owner' not in roles.lower() and 'mod' not in roles.lower()):
         return redirect('/conta')
     manager = WordFilterManager()
@@ -274,16 +273,16 @@ def word_filters_page():
 def register():
     if 'username' in session:
         return redirect('/conta')
-    captcha_text, captcha_image = database_module.generate_captcha()
-    session['captcha_text'] = database_module.hash_captcha(captcha_text)
+    captcha_image, captcha_hash = captcha_module.take_captcha()
+    session['captcha_text'] = captcha_hash
     form_data = session.pop('form_data', {})
     return render_template('register.html',captcha_image=captcha_image, form_data=form_data)
 
 @boards_bp.route('/create')
 def create():
     if 'username' in session:
-        captcha_text, captcha_image = database_module.generate_captcha()
-        session['captcha_text'] = database_module.hash_captcha(captcha_text)
+        captcha_image, captcha_hash = captcha_module.take_captcha()
+        session['captcha_text'] = captcha_hash
         form_data = session.pop('form_data', {})
         return render_template('board-create.html',captcha_image=captcha_image, form_data=form_data)
     else:
@@ -329,19 +328,7 @@ def board_page(board_uri):
         max_pages_per_board = 0
 
     if max_pages_per_board > 0:
-        posts_for_board = database_module.DB.query('posts', {'board': {'==': board_uri}})
-        posts_for_board.sort(key=lambda p: p.get('post_id', 0))
-        max_posts_allowed = posts_per_page * max_pages_per_board
-        if len(posts_for_board) > max_posts_allowed:
-            overflow_posts = posts_for_board[:-max_posts_allowed]
-            for old_post in overflow_posts:
-                old_post_id = old_post.get('post_id')
-                if old_post_id is None:
-                    continue
-                old_replies = database_module.DB.query('replies', {'post_id': {'==': old_post_id}})
-                for old_reply in old_replies:
-                    database_module.DB.delete('replies', old_reply['id'])
-                database_module.DB.delete('posts', old_post['id'])
+        database_module.prune_board_threads(board_uri, posts_per_page * max_pages_per_board)
 
     posts = database_module.load_db_page(board_uri, offset=offset, limit=posts_per_page)
     pinneds = database_module.get_pinned_posts(board_uri)
@@ -352,25 +339,23 @@ def board_page(board_uri):
     total_pages = (total_posts + posts_per_page - 1) // posts_per_page
     
     # Generate CAPTCHA
-    captcha_text, captcha_image = database_module.generate_captcha()
-    session['captcha_text'] = database_module.hash_captcha(captcha_text)
+    captcha_image, captcha_hash = captcha_module.take_captcha()
+    session['captcha_text'] = captcha_hash
     
-    ban_manager = BanManager()
-    visible_post_ids = [post['post_id'] for post in posts]
-    all_replies = database_module.DB.find_all('replies')
-    replies = [reply for reply in all_replies if reply['post_id'] in visible_post_ids]
-    mark_banned_flags(posts, board_uri, ban_manager)
-    mark_banned_flags(pinneds, board_uri, ban_manager)
-    mark_banned_flags(replies, board_uri, ban_manager)
+    visible_post_ids = [post['post_id'] for post in posts] + [pinned['post_id'] for pinned in pinneds]
+    replies = database_module.get_last_replies(visible_post_ids, per_thread=4)
+    mark_banned_flags(posts, board_uri)
+    mark_banned_flags(pinneds, board_uri)
+    mark_banned_flags(replies, board_uri)
     
     # Get user role if logged in
     roles = 'none'
     if 'username' in session:
-        roles = database_module.get_user_role(session["username"])
+        roles = request_context.user_role(session["username"])
     
     form_data = session.pop('form_data', {})
 
-    current_user_id, _ = resolve_user_identifier(request, session, anonymous_mode=chan_config.get('anonymous_mode'))
+    current_user_id = request_context.viewer_identifier()
     board_captcha_on = bool(board_info and board_info.get('enable_captcha', 0) == 1)
     anon_captcha_force = bool(should_force_captcha_for_identifier(current_user_id))
     show_captcha_for_user = board_captcha_on or anon_captcha_force
@@ -404,27 +389,22 @@ def board_catalog(board_uri):
     board_banner = database_module.get_board_banner(board_uri)
     
     # Generate CAPTCHA
-    captcha_text, captcha_image = database_module.generate_captcha()
-    session['captcha_text'] = database_module.hash_captcha(captcha_text)
+    captcha_image, captcha_hash = captcha_module.take_captcha()
+    session['captcha_text'] = captcha_hash
     
-    ban_manager = BanManager()
-    visible_post_ids = [post['post_id'] for post in posts]
-    all_replies = database_module.DB.find_all('replies')
-    replies = [reply for reply in all_replies if reply['post_id'] in visible_post_ids]
-    mark_banned_flags(posts, board_uri, ban_manager)
-    mark_banned_flags(pinneds, board_uri, ban_manager)
-    mark_banned_flags(replies, board_uri, ban_manager)
+    mark_banned_flags(posts, board_uri)
+    mark_banned_flags(pinneds, board_uri)
     
     # Get user role if logged in
     roles = 'none'
     if 'username' in session:
-        roles = database_module.get_user_role(session["username"])
+        roles = request_context.user_role(session["username"])
     
     form_data = session.pop('form_data', {})
 
     config_manager = ChanConfigManager()
     chan_config_catalog = config_manager.get_config()
-    current_user_id_catalog, _ = resolve_user_identifier(request, session, anonymous_mode=chan_config_catalog.get('anonymous_mode'))
+    current_user_id_catalog = request_context.viewer_identifier()
     board_captcha_on_catalog = bool(board_info and board_info.get('enable_captcha', 0) == 1)
     anon_captcha_force_catalog = bool(should_force_captcha_for_identifier(current_user_id_catalog))
     show_captcha_for_user_catalog = board_captcha_on_catalog or anon_captcha_force_catalog
@@ -437,7 +417,6 @@ def board_catalog(board_uri):
         roles=roles,
         pinneds=pinneds,
         posts=posts,
-        replies=replies,
         board_banner=board_banner,
         board_id=board_uri,
         form_data=form_data,
@@ -448,7 +427,7 @@ def board_banners(board_uri):
     roles = 'none'
     if "username" in session:
         username = session['username']
-        roles = database_module.get_user_role(session["username"])
+        roles = request_context.user_role(session["username"])
     else:
         username = 'anon'
     board_info = database_module.get_board_info(board_uri)
@@ -481,26 +460,34 @@ def replies(board_name, thread_id):
     if not thread:
         return redirect(url_for('boards.main_page'))
 
-    ban_manager = BanManager()
-    all_replies = database_module.DB.find_all('replies')
-    post_replies = [reply for reply in all_replies if reply.get('post_id') == thread_id]
-    mark_banned_flags(thread, board_name, ban_manager)
-    mark_banned_flags(post_replies, board_name, ban_manager)
+    # Optional window: ?last=N shows the newest N replies, &before=<reply no.> pages back.
+    reply_window = request.args.get('last', type=int)
+    earlier_before = request.args.get('before', type=int)
+    earlier_replies_count = 0
+    if reply_window and reply_window > 0:
+        post_replies, earlier_replies_count = database_module.get_thread_replies_window(
+            thread_id, reply_window, before=earlier_before)
+    else:
+        reply_window = None
+        post_replies = database_module.get_thread_replies(thread_id)
+
+    mark_banned_flags(thread, board_name)
+    mark_banned_flags(post_replies, board_name)
 
     # Generate CAPTCHA
-    captcha_text, captcha_image = database_module.generate_captcha()
-    session['captcha_text'] = database_module.hash_captcha(captcha_text)
+    captcha_image, captcha_hash = captcha_module.take_captcha()
+    session['captcha_text'] = captcha_hash
 
     # Get user role if logged in
     roles = 'none'
     if 'username' in session:
-        roles = database_module.get_user_role(session["username"])
+        roles = request_context.user_role(session["username"])
 
     form_data = session.pop('form_data', {})
 
     config_manager_thread = ChanConfigManager()
     chan_config_thread = config_manager_thread.get_config()
-    current_user_id_thread, _ = resolve_user_identifier(request, session, anonymous_mode=chan_config_thread.get('anonymous_mode'))
+    current_user_id_thread = request_context.viewer_identifier()
     board_captcha_on_thread = bool(board_info and board_info.get('enable_captcha', 0) == 1)
     anon_captcha_force_thread = bool(should_force_captcha_for_identifier(current_user_id_thread))
     show_captcha_for_user_thread = board_captcha_on_thread or anon_captcha_force_thread
@@ -512,6 +499,8 @@ def replies(board_name, thread_id):
         board_info=board_info,
         posts=thread,  # The original post
         replies=post_replies,
+        reply_window=reply_window,
+        earlier_replies_count=earlier_replies_count,
         board_id=board_name,
         thread_id=thread_id,
         post_mode="reply",
@@ -1,5 +1,5 @@
 from flask import current_app, Blueprint, render_template, redirect, request, flash, session, make_response
-from database_modules import database_module, moderation_module, formatting, language_module
+from database_modules import database_module, moderation_module, formatting, language_module, thumbnail_module
 from database_modules.moderation_module import (
     resolve_user_identifier,
     get_current_anonymous_mode,
@@ -9,6 +9,7 @@ from database_modules.moderation_module import (
     ANONYMOUS_MODE_ANONYMOUS,
     ANONYMOUS_MODE_HYBRID
 )
+from blueprints import request_context
 from flask_socketio import SocketIO, emit
 from datetime import datetime, timedelta
 from PIL import Image, ImageOps
@@ -87,18 +88,9 @@ class PostHandler:
         except (ValueError, TypeError):
             allow_name = 1
 
-        username = self.account_name
-        roles = database_module.get_user_role(username) if username else None
-        roles_lower = roles.lower() if roles else ''
-
         board_default_name = ''
         if board_info:
             board_default_name = board_info.get('default_poster_name') or ''
-            board_owner = board_info.get('board_owner')
-            board_staffs = board_info.get('board_staffs', [])
-        else:
-            board_owner = None
-            board_staffs = []
 
         chan_default_name = "Anonymous"
         try:
@@ -108,10 +100,8 @@ class PostHandler:
         except Exception:
             chan_default_name = "Anonymous"
 
-        is_global_admin = 'owner' in roles_lower or 'mod' in roles_lower
-        is_board_owner = bool(username and board_owner and username == board_owner)
-        is_board_staff = bool(username and username in board_staffs)
-        self.is_privileged = is_global_admin or is_board_owner or is_board_staff
+        self.is_privileged = bool(self.account_name) and request_context.board_permissions(
+            board_id, self.account_name)['is_privileged']
 
         raw_post_name = post_name or ''
 
@@ -128,13 +118,12 @@ class PostHandler:
         self.board_id = board_id
         self.thread_id = thread_id
         self.original_content = comment
-        try:
-            self.current_post_id = database_module.get_max_post_id() + 1
-        except Exception:
-            self.current_post_id = None
+        self.new_post_id = None
+        # Backlinks added to quoted replies need this post's number up front;
+        # otherwise it is only reserved once the post is accepted.
         self.comment = formatting.format_comment(
             comment,
-            current_post_id=self.current_post_id,
+            current_post_id=self.reserve_post_id() if re.search(r'>>\d', comment) else None,
             current_thread_id=self.thread_id
         )
         self.embed = embed
@@ -164,11 +153,11 @@ class PostHandler:
     # Check if the user is banned
     def check_banned(self):
         lang = self.lang
-        banned_current = self.ban_manager.is_banned(self.user_ip)
+        banned_current = request_context.ban_status(self.user_ip)
         banned_cookie = {'is_banned': False}
 
         if self.cookie_ip:
-            banned_cookie = self.ban_manager.is_banned(self.cookie_ip)
+            banned_cookie = request_context.ban_status(self.cookie_ip)
 
             if (
                 banned_cookie.get('is_banned', False)
@@ -193,7 +182,8 @@ class PostHandler:
                     reason="Evasor.",
                     moderator="System",
                 )
-                banned_current = self.ban_manager.is_banned(self.user_ip)
+                request_context.forget('ban', self.user_ip)
+                banned_current = request_context.ban_status(self.user_ip)
 
         for status in (banned_current, banned_cookie):
             if not status.get('is_banned', False):
@@ -208,7 +198,7 @@ class PostHandler:
         return True
     # Check if the user is in timeout
     def check_timeout(self):
-        timeout_status = self.timeout_manager.check_timeout(self.user_ip)
+        timeout_status = request_context.timeout_status(self.user_ip)
         if timeout_status.get('is_timeout', False):
             lang = self.lang
             flash(lang["flash-timeout-wait"])
@@ -365,7 +355,9 @@ class PostHandler:
                         
                         # Strip metadata by creating a new image or saving without exif
                         # ImageOps.exif_transpose returns a copy with rotation applied and orientation tag removed
-                        # We just need to clear the info dictionary to be sure
+                        # We just need to clear the info dictionary to be sure; the thumbnails
+                        # still need to know whether the original had a transparent colour
+                        original_info = img.info
                         img.info = {}
                         
                         # Handle formats
@@ -386,6 +378,12 @@ class PostHandler:
                             img = img.convert('RGB')
                             
                         img.save(file_path, format=format, quality=95, optimize=True)
+
+                        # Board and catalog pages show these instead of the full file.
+                        try:
+                            thumbnail_module.make_thumbnails(img, filename, thumb_folder, original_info)
+                        except Exception as e:
+                            print(f"Error generating thumbnails for {filename}: {e}")
                             
                     except Exception as e:
                         print(f"Error stripping metadata for {filename}: {e}")
@@ -419,6 +417,12 @@ class PostHandler:
             return f"youtube:{match.group(1)}"
         return None
 
+    def reserve_post_id(self):
+        """Reserve this post's public number from the post sequence, once."""
+        if self.new_post_id is None:
+            self.new_post_id = database_module.next_post_id()
+        return self.new_post_id
+
     # Handle reply posts
     def handle_reply(self, reply_to):
         lang = self.lang
@@ -461,6 +465,7 @@ class PostHandler:
         media_approved = self.get_media_approval_status(bool(saved_files))
         
         poster_id = poster_id_hash(self.user_ip, reply_to)
+        reply_id = self.reserve_post_id()
         board_info = database_module.get_board_info(self.board_id)
         try:
             show_poster_id = int(board_info.get('show_thread_poster_id', 0) or 0) if board_info else 0
@@ -471,7 +476,7 @@ class PostHandler:
             'type': 'New Reply',
             'i18n': socket_post_i18n(self.lang, self.board_lang_key),
             'post': {
-                'id': database_module.get_max_post_id() + 1,
+                'id': reply_id,
                 'thread_id': reply_to,
                 'name': f'{display_name}{tripcode_html}',
                 'subject': self.post_subject,
@@ -486,7 +491,8 @@ class PostHandler:
                 'role': 'user' # Default for replies
             }
         }, broadcast=True)
-        database_module.add_new_reply(self.user_ip, self.account_name, self.post_subject, reply_to, self.post_name, self.comment, self.embed, saved_files)
+        database_module.add_new_reply(self.user_ip, self.account_name, self.post_subject, reply_to, self.post_name, self.comment, self.embed, saved_files,
+                                      reply_id=reply_id, role=request_context.user_role(self.account_name))
         self.timeout_manager.apply_timeout(self.user_ip, duration_seconds=35, reason="Automatic timeout.")
         return True
     # Capture a frame from the video to use as thumbnail
@@ -531,32 +537,21 @@ class PostHandler:
         if not has_files:
             return 1
             
-        board = database_module.DB.query('boards', {'board_uri': {'==': self.board_id}})
+        board = database_module.get_board_info(self.board_id)
         if not board:
             return 1
             
         try:
-            require_media_approval = int(board[0].get('require_media_approval', 0))
+            require_media_approval = int(board.get('require_media_approval', 0))
         except (ValueError, TypeError):
             require_media_approval = 0
             
         if require_media_approval == 0:
             return 1
             
-        # Check privileges
-        board_owner = board[0]['board_owner']
-        board_staffs = board[0]['board_staffs']
-        
-        if self.account_name == board_owner:
-            return 1
-        if self.account_name in board_staffs:
+        # Owner, global mod or board staff (memoized in __init__)
+        if self.is_privileged:
             return 1
-            
-        user = database_module.DB.query('accounts', {'username': {'==': self.account_name}})
-        if user:
-            role = user[0]['role'].lower()
-            if 'mod' in role or 'owner' in role:
-                return 1
                 
         return 0
 
@@ -591,7 +586,7 @@ class PostHandler:
             tripcode_html = f' <span class="tripcode">[tripcode protected]</span>'
         
         media_approved = self.get_media_approval_status(bool(saved_files))
-        next_post_id = database_module.get_max_post_id() + 1
+        next_post_id = self.reserve_post_id()
         board_info = database_module.get_board_info(self.board_id)
         try:
             show_poster_id = int(board_info.get('show_thread_poster_id', 0) or 0) if board_info else 0
@@ -618,7 +613,8 @@ class PostHandler:
             }
         }, broadcast=True)
         database_module.add_new_post(self.user_ip, self.account_name, self.board_id, self.post_subject, self.post_name, 
-                                   self.original_content, self.comment, self.embed, saved_files)
+                                     self.original_content, self.comment, self.embed, saved_files, post_id=next_post_id,
+                                     role=request_context.user_role(self.account_name))
         self.timeout_manager.apply_timeout(self.user_ip, duration_seconds=35, reason="Automatic timeout.")
         return True
 # Route to handle new posts
@@ -751,7 +747,7 @@ def new_post():
                 return redirect(f"/{board_id}/thread/{reply_to_info.get('post_id')}#{reply_to}")
         except:
             pass
-        response = redirect(f'/{board_id}/thread/{database_module.get_max_post_id()}')
+        response = redirect(f'/{board_id}/thread/{handler.new_post_id}')
 
     response_anchor['response'] = response
     # Re-resolve to persist any newly created anonymous identifier cookie on this response
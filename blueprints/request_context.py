@@ -0,0 +1,83 @@
+"""
+Request-scoped memoization of who the viewer is.
+Role, board permissions, identifier and ban/timeout status are looked up at
+most once per request and shared by decorators, routes, context processors
+and PostHandler through flask.g.
+"""
+
+from flask import g, has_request_context, request, session
+from database_modules import database_module
+from database_modules.moderation_module import BanManager, TimeoutManager, resolve_user_identifier
+
+_ban_manager = BanManager()
+_timeout_manager = TimeoutManager()
+
+def _memo(key, compute):
+    if not has_request_context():
+        return compute()
+    cache = g.setdefault('_request_memo', {})
+    if key not in cache:
+        cache[key] = compute()
+    return cache[key]
+
+def forget(*key):
+    """Drop one memoized value, e.g. after banning the current poster."""
+    if has_request_context():
+        g.setdefault('_request_memo', {}).pop(key, None)
+
+def user_role(username):
+    """Role of an account (None for anonymous or unknown users)."""
+    if not username:
+        return None
+    return _memo(('role', username), lambda: database_module.get_user_acl(username)['role'])
+
+def user_acl(username):
+    """database_module.get_user_acl (None for anonymous users)."""
+    if not username:
+        return None
+    return _memo(('acl', username), lambda: database_module.get_user_acl(username))
+
+def viewer_username():
+    return session.get('username')
+
+def viewer_role():
+    return user_role(viewer_username())
+
+def is_global_staff(username=None):
+    """Owner or global mod."""
+    roles = (user_role(username) if username else viewer_role()) or ''
+    roles = roles.lower()
+    return 'owner' in roles or 'mod' in roles
+
+def board_permissions(board_uri, username=None):
+    """
+    {'is_admin', 'is_owner', 'is_staff', 'is_privileged'} of a user (the viewer
+    by default) on a board.
+    """
+    username = username or viewer_username()
+
+    def compute():
+        acl = user_acl(username)
+        is_admin = bool(acl and acl['is_global_staff'])
+        is_owner = bool(acl and board_uri in acl['owned_boards'])
+        is_staff = bool(acl and board_uri in acl['staff_boards'])
+        return {
+            'is_admin': is_admin,
+            'is_owner': is_owner,
+            'is_staff': is_staff,
+            'is_privileged': is_admin or is_owner or is_staff
+        }
+
+    return _memo(('board_permissions', board_uri, username), compute)
+
+def viewer_identifier():
+    """Effective identifier of the viewer (IP or anonymous hash), see resolve_user_identifier."""
+    return _memo(('identifier',), lambda: resolve_user_identifier(request, session)[0])
+
+def ban_status(identifier):
+    """BanManager.is_banned(identifier), once per request and identifier."""
+    return _memo(('ban', identifier), lambda: _ban_manager.is_banned(identifier))
+
+def timeout_status(identifier):
+    """TimeoutManager.check_timeout(identifier), once per request and identifier."""
+    return _memo(('timeout', identifier), lambda: _timeout_manager.check_timeout(identifier))
@@ -0,0 +1,374 @@
+"""
+Imageboard Captcha Pool.
+Pages only issue a challenge: a nonce, whose answer is derived from it
+(database_module.captcha_answer), signed into the session token when issued,
+and an image URL, /api/captcha/<nonce>.png. The image itself is rendered only
+when the browser loads it, i.e. when the post form is shown.
+
+To keep rendering off the request path, a background thread keeps a bounded
+pool of pre-rendered challenges; issuing one moves its image into a small
+cache the image endpoint serves from. A challenge issued while the pool is
+empty, or loaded by another worker, is rendered on demand from its nonce.
+
+Images are drawn by render_captcha with NumPy: the mosaic and the glitch line
+are array operations and glyph bitmaps are cached, then the image is encoded
+as a small grayscale palette PNG, or WebP. `python -m
+database_modules.captcha_module` compares it with the original PIL renderer.
+
+Configured through the environment:
+    RCHAN_CAPTCHA_POOL_SIZE    challenges kept ready (default 64, 0 disables the pool)
+    RCHAN_CAPTCHA_REFILL_RATE  challenges generated per second at most (default 20)
+    RCHAN_CAPTCHA_FORMAT       png (default) or webp
+"""
+
+import atexit
+import io
+import os
+import random
+import re
+import secrets
+import threading
+import time
+from collections import OrderedDict, deque
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+from database_modules import database_module
+
+POOL_SIZE = int(os.environ.get('RCHAN_CAPTCHA_POOL_SIZE', '64'))
+REFILL_RATE = float(os.environ.get('RCHAN_CAPTCHA_REFILL_RATE', '20'))
+IMAGE_FORMAT = os.environ.get('RCHAN_CAPTCHA_FORMAT', 'png').lower()
+IMAGE_FORMATS = {'png': 'image/png', 'webp': 'image/webp'}
+ISSUED_CACHE_SIZE = 1024
+NONCE_RE = re.compile(r'^[A-Za-z0-9_-]{16}$')
+
+WIDTH, HEIGHT = 200, 80
+BOX_SIZE = 10
+FONT_SIZE = 42
+FONT_PATHS = (
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'static', 'css', 'fonts', 'comic.ttf'),
+    "/usr/share/fonts/truetype/msttcorefonts/Comic_Sans_MS.ttf"
+)
+WHITE, GRAY, BLACK = 255, 224, 0
+# Grayscale palette of the PNG output: white, mosaic gray, black and the text's anti-aliasing.
+PALETTE_LEVELS = np.array([255, 224, 170, 112, 56, 0], dtype=np.uint8)
+
+_issued = OrderedDict()  # {nonce: image bytes} of issued, not yet loaded challenges
+_issued_lock = threading.Lock()
+_font = None
+_glyphs = {}  # {char: (bitmap, x offset, y offset from baseline, advance)}
+_glyphs_lock = threading.Lock()
+_palette_lut = None
+
+# Rendering
+def _get_font():
+    global _font
+    if _font is None:
+        for path in FONT_PATHS:
+            try:
+                _font = ImageFont.truetype(path, FONT_SIZE)
+                break
+            except IOError:
+                continue
+        else:
+            _font = ImageFont.load_default()
+    return _font
+
+def _glyph(char):
+    """Coverage bitmap of one character, rendered once per process."""
+    glyph = _glyphs.get(char)
+    if glyph is None:
+        font = _get_font()
+        left, top, right, bottom = font.getbbox(char, anchor='ls')
+        image = Image.new('L', (max(right - left, 1), max(bottom - top, 1)), 0)
+        ImageDraw.Draw(image).text((-left, -top), char, font=font, fill=255, anchor='ls')
+        glyph = (np.asarray(image, dtype=np.uint16), left, top, font.getlength(char))
+        with _glyphs_lock:
+            _glyphs[char] = glyph
+    return glyph
+
+def _draw_text(pixels, text):
+    """Composite black text centred on the image, like draw.text(anchor='mm')."""
+    ascent, descent = _get_font().getmetrics()
+    glyphs = [_glyph(char) for char in text]
+    pen_x = WIDTH / 2 - sum(glyph[3] for glyph in glyphs) / 2
+    baseline = HEIGHT / 2 + (ascent - descent) / 2
+    for bitmap, left, top, advance in glyphs:
+        x0 = int(round(pen_x + left))
+        y0 = int(round(baseline + top))
+        pen_x += advance
+        # Clip the glyph to the image.
+        gx0, gy0 = max(0, -x0), max(0, -y0)
+        gx1 = min(bitmap.shape[1], WIDTH - x0)
+        gy1 = min(bitmap.shape[0], HEIGHT - y0)
+        if gx0 >= gx1 or gy0 >= gy1:
+            continue
+        region = pixels[y0 + gy0:y0 + gy1, x0 + gx0:x0 + gx1]
+        coverage = bitmap[gy0:gy1, gx0:gx1]
+        region[...] = region * (255 - coverage) // 255
+
+def _draw_glitch_line(pixels, rng):
+    """Jittered 4px line through the middle, plus the odd glitch block."""
+    step = 5
+    xs = np.arange(0, WIDTH + step, step)
+    ys = HEIGHT / 2 + np.concatenate(([0], rng.integers(-1, 2, len(xs) - 1)))
+    line_y = np.interp(np.arange(WIDTH), xs, ys)
+    rows = np.arange(HEIGHT)[:, None]
+    pixels[np.abs(rows - line_y[None, :]) <= 2] = BLACK
+
+    for x, y in zip(xs[1:][rng.random(len(xs) - 1) < 0.05], ys[1:]):
+        w, h = rng.integers(2, 7, 2)
+        g_x = int(x - rng.integers(0, step + 1))
+        g_y = int(y + rng.integers(-4, 5))
+        pixels[max(g_y, 0):max(g_y + h + 1, 0), max(g_x, 0):max(g_x + w + 1, 0)] = BLACK
+
+def _encode(pixels, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'webp':
+        Image.fromarray(pixels, 'L').save(buffer, format='WEBP', lossless=True, method=0)
+    else:
+        global _palette_lut
+        if _palette_lut is None:
+            # Nearest palette entry for every gray level.
+            levels = PALETTE_LEVELS.astype(np.int16)
+            _palette_lut = np.abs(np.arange(256)[:, None] - levels[None, :]).argmin(axis=1).astype(np.uint8)
+        image = Image.fromarray(_palette_lut[pixels], 'P')
+        image.putpalette(np.repeat(PALETTE_LEVELS, 3).tolist())
+        image.save(buffer, format='PNG', bits=3)
+    return buffer.getvalue()
+
+def render_captcha(captcha_text, image_format=IMAGE_FORMAT, seed=None):
+    """
+    Render a CAPTCHA challenge for captcha_text as PNG (or WebP) bytes; the
+    same seed always draws the same mosaic and line.
+    """
+    rng = np.random.default_rng(seed)
+    # Mosaic background: one random white/gray cell per BOX_SIZE square.
+    cells = np.where(rng.random((HEIGHT // BOX_SIZE, WIDTH // BOX_SIZE)) > 0.5, GRAY, WHITE).astype(np.uint8)
+    pixels = np.repeat(np.repeat(cells, BOX_SIZE, axis=0), BOX_SIZE, axis=1)
+    _draw_text(pixels, captcha_text)
+    _draw_glitch_line(pixels, rng)
+    return _encode(pixels, image_format)
+
+def render_captcha_pil(captcha_text):
+    """
+    The original PIL renderer (a draw.rectangle per mosaic tile, font loaded
+    per call), kept as the baseline for benchmark().
+    """
+    # 1. Setup Image
+    width, height = 200, 80
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    
+    # 2. Draw Mosaic Background (White and Gray)
+    box_size = 10
+    for x in range(0, width, box_size):
+        for y in range(0, height, box_size):
+            if random.random() > 0.5:
+                fill_color = '#e0e0e0' # Light Gray
+            else:
+                fill_color = 'white'
+            draw.rectangle([x, y, x + box_size, y + box_size], fill=fill_color)
+            
+    # 3. Load Font (Comic Sans from static/css/fonts)
+    # Construct path relative to this file
+    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    font_path = os.path.join(base_dir, 'static', 'css', 'fonts', 'comic.ttf')
+    
+    try:
+        font = ImageFont.truetype(font_path, 42)
+    except IOError:
+        # Fallback to system font if local font fails
+        font_path = "/usr/share/fonts/truetype/msttcorefonts/Comic_Sans_MS.ttf"
+        try:
+             font = ImageFont.truetype(font_path, 42)
+        except IOError:
+             font = ImageFont.load_default()
+
+    # 4. Draw Text (Centered)
+    # Using anchor='mm' (middle-middle) to center text bounding box relative to image center
+    # This requires Pillow >= 8.0.0 (Project uses 11.0.0)
+    
+    cx = width / 2
+    cy = height / 2
+    
+    draw.text((cx, cy), captcha_text, font=font, fill='black', anchor='mm')
+    
+    # 5. Draw Horizontal Line Cutting Through Middle of Text with Glitch Effect
+    # Base line Y is cy
+    line_thickness = 4
+    
+    prev_x = 0
+    prev_y = cy
+    
+    step = 5
+    for x in range(step, width + step, step):
+        # Random vertical jitter
+        y_jitter = random.randint(-1, 1)
+        curr_y = cy + y_jitter
+        
+        # Draw segment
+        draw.line((prev_x, prev_y, x, curr_y), fill='black', width=line_thickness)
+        
+        # Randomly add "glitch" blocks
+        if random.random() < 0.05: # 5% chance
+            glitch_w = random.randint(2, 6)
+            glitch_h = random.randint(2, 6)
+            g_x = x - random.randint(0, step)
+            g_y = curr_y + random.randint(-4, 4)
+            draw.rectangle([g_x, g_y, g_x + glitch_w, g_y + glitch_h], fill='black')
+            
+        prev_x = x
+        prev_y = curr_y
+    
+    # 6. Save to Buffer
+    image_io = io.BytesIO()
+    image.save(image_io, format='PNG')
+    return image_io.getvalue()
+
+# Challenges
+def new_nonce():
+    return secrets.token_urlsafe(12)
+
+def render_challenge(nonce, image_format=IMAGE_FORMAT):
+    # Seeded from the nonce: fetching one challenge again returns the same bytes.
+    return render_captcha(database_module.captcha_answer(nonce), image_format,
+                          seed=database_module.captcha_noise_seed(nonce))
+
+def make_challenge():
+    """A fresh (nonce, image bytes) pair."""
+    nonce = new_nonce()
+    return nonce, render_challenge(nonce)
+
+class CaptchaPool:
+    def __init__(self, size=POOL_SIZE, refill_rate=REFILL_RATE, factory=make_challenge):
+        self.size = size
+        self.refill_rate = refill_rate
+        self.factory = factory
+        self._items = deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Condition(self._lock)
+        self._worker = None
+        self._pid = None
+        self._stopping = False
+        self.generated = 0
+        self.served = 0
+        self.misses = 0
+
+    def _ensure_worker(self):
+        """Start the refill thread on first use; called with the lock held."""
+        if self.size <= 0:
+            return
+        pid = os.getpid()
+        if self._pid == pid and self._worker.is_alive():
+            return
+        if self._pid != pid:
+            # Forked worker: the parent's thread did not survive the fork, and
+            # challenges inherited from it would be served by both processes.
+            self._items.clear()
+            self._pid = pid
+        self._worker = threading.Thread(target=self._fill, name='captcha-pool', daemon=True)
+        self._worker.start()
+
+    def stop(self):
+        """Let the refill thread finish its current challenge and exit."""
+        with self._lock:
+            self._stopping = True
+            self._wanted.notify_all()
+            worker = self._worker if self._pid == os.getpid() else None
+        if worker is not None:
+            worker.join(timeout=5)
+
+    def _fill(self):
+        interval = 1.0 / self.refill_rate if self.refill_rate > 0 else 0
+        while True:
+            with self._lock:
+                while len(self._items) >= self.size and not self._stopping:
+                    self._wanted.wait()
+                if self._stopping:
+                    return
+            started = time.monotonic()
+            try:
+                challenge = self.factory()
+            except Exception as e:
+                print(f"Error generating captcha: {e}")
+                time.sleep(1)
+                continue
+            with self._lock:
+                self._items.append(challenge)
+                self.generated += 1
+            remaining = interval - (time.monotonic() - started)
+            if remaining > 0:
+                time.sleep(remaining)
+
+    def take(self):
+        """An unused pre-rendered challenge, or None if the pool is empty."""
+        with self._lock:
+            self._ensure_worker()
+            self.served += 1
+            if self._items:
+                challenge = self._items.popleft()
+                self._wanted.notify()
+                return challenge
+            self.misses += 1
+        return None
+
+    def metrics(self):
+        with self._lock:
+            return {
+                'pool_size': len(self._items),
+                'pool_capacity': self.size,
+                'refill_rate': self.refill_rate,
+                'generated': self.generated,
+                'served': self.served,
+                'misses': self.misses
+            }
+
+POOL = CaptchaPool()
+# A daemon thread killed inside PIL at interpreter exit aborts the process.
+atexit.register(POOL.stop)
+
+def take_captcha():
+    """(image URL, token for session['captcha_text']) of a fresh challenge."""
+    challenge = POOL.take()
+    if challenge is None:
+        nonce = new_nonce()  # rendered when its image is loaded
+    else:
+        nonce, image = challenge
+        with _issued_lock:
+            _issued[nonce] = image
+            if len(_issued) > ISSUED_CACHE_SIZE:
+                _issued.popitem(last=False)
+    token = database_module.hash_captcha(database_module.captcha_answer(nonce), nonce=nonce)
+    return f"/api/captcha/{nonce}.{IMAGE_FORMAT}", token
+
+def captcha_image(nonce, image_format=IMAGE_FORMAT):
+    """Image bytes of an issued challenge, pre-rendered if this worker has it, else rendered now."""
+    if not NONCE_RE.match(nonce or '') or image_format not in IMAGE_FORMATS:
+        return None
+    image = None
+    if image_format == IMAGE_FORMAT:
+        with _issued_lock:
+            image = _issued.pop(nonce, None)
+    return image if image is not None else render_challenge(nonce, image_format)
+
+def pool_metrics():
+    return POOL.metrics()
+
+def benchmark(iterations=200):
+    """Time and size of the original PIL renderer against render_captcha."""
+    text = 'abc123'
+    candidates = [
+        ('pil (original)', render_captcha_pil),
+        ('numpy png', lambda t: render_captcha(t, 'png')),
+        ('numpy webp', lambda t: render_captcha(t, 'webp'))
+    ]
+    for name, render in candidates:
+        render(text)  # warm up fonts and glyph caches
+        started = time.perf_counter()
+        for _ in range(iterations):
+            image = render(text)
+        elapsed = (time.perf_counter() - started) / iterations
+        print(f"{name:16} {elapsed * 1000:7.3f} ms/image {len(image):6} bytes")
+
+if __name__ == '__main__':
+    benchmark()
@@ -5,26 +5,28 @@ This module handles all database operations for an imageboard system.
 
 import datetime
 import hashlib
+import hmac
 import random
-import bcrypt
-import base64
+import secrets
+import sqlite3
+import time
 import string
 import pytz
-import json
 import os
-import io
 import re
-from threading import Lock
-from PIL import Image, ImageDraw, ImageFont
-from database_modules.sqlite_handler import SQLiteConfig
+import copy
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import suppress
+from database_modules.sqlite_handler import SQLiteConfig, VersionCounter
+from database_modules.records import Board, Post, Reply
+from database_modules import thumbnail_module
 from database_modules.moderation_module import DEFAULT_SITE_TIMEZONE
 
-# Initialize Lock for post ID generation
-POST_LOCK = Lock()
-
-# Initialize SQLite databases
+# Initialize SQLite databases. Tables are created and upgraded by MIGRATIONS (end of module).
 DB = SQLiteConfig.load_db('imageboard')
-DB.create_table('boards', {
+DB.define_table('boards', {
     'id': 'int',
     'board_uri': 'str',
     'board_name': 'str',
@@ -45,16 +47,16 @@ DB.create_table('boards', {
     'custom_css': 'str',
     'default_poster_name': 'str',
     'board_lang': 'str'
-})
+}, unique=['board_uri'], indexes=['board_owner'], record_class=Board)
 
-DB.create_table('accounts', {
+DB.define_table('accounts', {
     'id': 'int',
     'username': 'str',
     'password': 'str',
     'role': 'str'
-})
+}, unique=['username'])
 
-DB.create_table('posts', {
+DB.define_table('posts', {
     'id': 'int',
     'user_ip': 'str',
     'post_id': 'int',
@@ -67,10 +69,15 @@ DB.create_table('posts', {
     'post_images': 'list',
     'locked': 'int',
     'visible': 'int',
-    'media_approved': 'int'
-})
-
-DB.create_table('pinned', {
+    'media_approved': 'int',
+    'bumped_at': 'int',
+    'reply_count': 'int',
+    'image_count': 'int',
+    'last_reply_id': 'int',
+    'last_reply_at': 'str'
+}, indexes=['board', 'post_id', 'user_ip', ('board', 'bumped_at')], record_class=Post)
+
+DB.define_table('pinned', {
     'id': 'int',
     'user_ip': 'str',
     'post_id': 'int',
@@ -82,9 +89,9 @@ DB.create_table('pinned', {
     'post_images': 'list',
     'locked': 'int',
     'media_approved': 'int'
-})
+}, indexes=['board', 'post_id'])
 
-DB.create_table('replies', {
+DB.define_table('replies', {
     'id': 'int',
     'user_ip': 'str',
     'reply_id': 'int',
@@ -96,123 +103,193 @@ DB.create_table('replies', {
     'images': 'list',
     'media_approved': 'int',
     'replied_at': 'list'
-})
+}, indexes=['post_id', 'reply_id', 'user_ip', ('post_id', 'reply_id')], record_class=Reply)
 
-DB.create_table('users', {
+DB.define_table('users', {
     'id': 'int',
     'user_ip': 'str',
     'user_role': 'str'
 })
 
+# Normalised copy of boards.board_staffs, so a user's boards are found by username.
+DB.define_table('board_staff', {
+    'id': 'int',
+    'board_uri': 'str',
+    'username': 'str'
+}, unique=[('board_uri', 'username')], indexes=['username'])
+
+# Per-board counters, kept in sync on post, reply, delete, move and prune.
+DB.define_table('board_stats', {
+    'id': 'int',
+    'board_uri': 'str',
+    'thread_count': 'int',
+    'reply_count': 'int',
+    'last_activity': 'str',
+    'last_post_id': 'int'
+}, unique=['board_uri'], indexes=['last_post_id'])
+
+# Captcha tokens already used, until they expire (see validate_captcha).
+DB.define_table('captcha_used', {
+    'id': 'int',
+    'nonce': 'str',
+    'expires': 'int'
+}, unique=['nonce'], indexes=['expires'])
+
+# Public post numbers are shared by threads and replies.
+POST_SEQUENCE = 'post_id'
+# Bump order for board pages.
+BUMP_SEQUENCE = 'bump'
+# Bumped on every board change, so each worker drops its cached board settings.
+BOARDS_VERSION = VersionCounter(DB, 'boards')
+BOARD_CACHE_SIZE = 256
+_board_cache = OrderedDict()  # {board_uri: board record or None}, least recently used first
+_board_cache_version = None
+_board_cache_lock = threading.Lock()
+# Bumped on account role changes; together with BOARDS_VERSION it invalidates cached ACLs.
+ACCOUNTS_VERSION = VersionCounter(DB, 'accounts')
+ACL_CACHE_SIZE = 1024
+_acl_cache = OrderedDict()  # {username: acl}, least recently used first
+_acl_cache_version = None
+_acl_cache_lock = threading.Lock()
+
+# Captcha tokens: "<expires>.<nonce>.<hmac>", kept in session['captcha_text'].
+CAPTCHA_TOKEN_TTL = 1800  # seconds a served captcha stays valid
+CAPTCHA_KEY_FILE = 'databases/captcha.key'
+_captcha_key = None
+_captcha_key_lock = threading.Lock()
+
 # Utility Functions
-def hash_captcha(text: str) -> str:
+def _get_captcha_key():
     """
-    Gera hash do captcha usando bcrypt.
-    
-    :param text: Texto do captcha
-    :return: Hash (string)
+    HMAC key for captcha tokens, shared by every worker: RCHAN_CAPTCHA_SECRET
+    if set, otherwise a random key created once in CAPTCHA_KEY_FILE.
     """
-    salt = bcrypt.gensalt()
-    hashed = bcrypt.hashpw(text.encode('utf-8'), salt)
-    return hashed.decode('utf-8')
-
-def generate_captcha():
-    """Generate a custom CAPTCHA challenge."""
-    # 1. Generate text (lowercase + digits)
-    captcha_text = ''.join(random.choices(string.ascii_lowercase + string.digits, k=6))
-    
-    # 2. Setup Image
-    width, height = 200, 80
-    image = Image.new('RGB', (width, height), 'white')
-    draw = ImageDraw.Draw(image)
-    
-    # 3. Draw Mosaic Background (White and Gray)
-    box_size = 10
-    for x in range(0, width, box_size):
-        for y in range(0, height, box_size):
-            if random.random() > 0.5:
-                fill_color = '#e0e0e0' # Light Gray
-            else:
-                fill_color = 'white'
-            draw.rectangle([x, y, x + box_size, y + box_size], fill=fill_color)
-            
-    # 4. Load Font (Comic Sans from static/css/fonts)
-    # Construct path relative to this file
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    font_path = os.path.join(base_dir, 'static', 'css', 'fonts', 'comic.ttf')
-    
+    global _captcha_key
+    if _captcha_key is not None:
+        return _captcha_key
+    with _captcha_key_lock:
+        if _captcha_key is not None:
+            return _captcha_key
+        secret = os.environ.get('RCHAN_CAPTCHA_SECRET')
+        if secret:
+            _captcha_key = secret.encode('utf-8')
+            return _captcha_key
+        if not os.path.exists(CAPTCHA_KEY_FILE):
+            _create_captcha_key_file()
+        for _ in range(100):
+            with open(CAPTCHA_KEY_FILE, 'rb') as f:
+                key = f.read()
+            if key:
+                break
+            time.sleep(0.01)  # Another worker created it with O_EXCL and is still writing.
+        else:
+            raise RuntimeError(f"{CAPTCHA_KEY_FILE} is empty")
+        _captcha_key = key
+    return _captcha_key
+
+def _create_captcha_key_file():
+    """Create CAPTCHA_KEY_FILE unless another worker wins the race; never replaces it."""
+    key = secrets.token_bytes(32)
+    # Written aside under a unique name and linked into place, so no worker reads a partial key.
+    key_dir = os.path.dirname(CAPTCHA_KEY_FILE) or '.'
+    os.makedirs(key_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=key_dir, prefix='.captcha.key.')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(key)
     try:
-        font = ImageFont.truetype(font_path, 42)
-    except IOError:
-        # Fallback to system font if local font fails
-        font_path = "/usr/share/fonts/truetype/msttcorefonts/Comic_Sans_MS.ttf"
+        os.link(tmp_path, CAPTCHA_KEY_FILE)
+    except FileExistsError:
+        pass
+    except OSError:
+        # No hard links on this filesystem: claim the name with an exclusive create.
         try:
-             font = ImageFont.truetype(font_path, 42)
-        except IOError:
-             font = ImageFont.load_default()
+            fd = os.open(CAPTCHA_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        except FileExistsError:
+            return
+        with os.fdopen(fd, 'wb') as f:
+            f.write(key)
+    finally:
+        with suppress(FileNotFoundError):
+            os.remove(tmp_path)
+
+def _captcha_mac(expires, nonce, text):
+    message = f"{expires}.{nonce}.{text}".encode('utf-8')
+    return hmac.new(_get_captcha_key(), message, hashlib.sha256).hexdigest()
+
+@DB.atomic
+def _record_captcha_nonce(nonce, expires, now):
+    DB.delete_where('captcha_used', {'expires': {'<': now}})
+    DB.insert('captcha_used', {'nonce': nonce, 'expires': expires}, on_conflict='abort')
+
+def _claim_captcha_nonce(nonce, expires, now):
+    """
+    Record a token as used in captcha_used, shared by every worker and kept
+    across restarts; False if it already was (replay). Expired rows are pruned.
+    """
+    try:
+        _record_captcha_nonce(nonce, expires, now)
+    except sqlite3.IntegrityError:
+        return False
+    return True
 
-    # 5. Draw Text (Centered)
-    # Using anchor='mm' (middle-middle) to center text bounding box relative to image center
-    # This requires Pillow >= 8.0.0 (Project uses 11.0.0)
-    
-    cx = width / 2
-    cy = height / 2
-    
-    draw.text((cx, cy), captcha_text, font=font, fill='black', anchor='mm')
-    
-    # 6. Draw Horizontal Line Cutting Through Middle of Text with Glitch Effect
-    # Base line Y is cy
-    line_thickness = 4
-    
-    prev_x = 0
-    prev_y = cy
-    
-    step = 5
-    for x in range(step, width + step, step):
-        # Random vertical jitter
-        y_jitter = random.randint(-1, 1)
-        curr_y = cy + y_jitter
-        
-        # Draw segment
-        draw.line((prev_x, prev_y, x, curr_y), fill='black', width=line_thickness)
-        
-        # Randomly add "glitch" blocks
-        if random.random() < 0.05: # 5% chance
-            glitch_w = random.randint(2, 6)
-            glitch_h = random.randint(2, 6)
-            g_x = x - random.randint(0, step)
-            g_y = curr_y + random.randint(-4, 4)
-            draw.rectangle([g_x, g_y, g_x + glitch_w, g_y + glitch_h], fill='black')
-            
-        prev_x = x
-        prev_y = curr_y
-    
-    # 7. Save to Buffer
-    image_io = io.BytesIO()
-    image.save(image_io, format='PNG')
-    image_base64 = base64.b64encode(image_io.getvalue()).decode('utf-8')
+def captcha_answer(nonce):
+    """
+    Answer of the challenge identified by nonce (6 lowercase letters/digits).
+    Derived from the captcha key, so any worker can render a challenge from
+    its nonce alone without the answer leaving the server.
+    """
+    digest = hmac.new(_get_captcha_key(), f"answer.{nonce}".encode('utf-8'), hashlib.sha256).digest()
+    alphabet = string.ascii_lowercase + string.digits
+    return ''.join(alphabet[byte % len(alphabet)] for byte in digest[:6])
+
+def captcha_noise_seed(nonce):
+    """
+    Seed for the noise drawn on the challenge's image, derived like its answer,
+    so every render of a nonce is identical and cannot be averaged out.
+    """
+    digest = hmac.new(_get_captcha_key(), f"noise.{nonce}".encode('utf-8'), hashlib.sha256).digest()
+    return int.from_bytes(digest, 'big')
+
+def hash_captcha(text: str, nonce=None) -> str:
+    """
+    Sign a captcha answer into a one-time token that expires after
+    CAPTCHA_TOKEN_TTL seconds.
     
-    return captcha_text, f"data:image/png;base64,{image_base64}"
+    :param text: Texto do captcha
+    :param nonce: Challenge id (see captcha_answer); random if omitted
+    :return: Token (string)
+    """
+    expires = int(time.time()) + CAPTCHA_TOKEN_TTL
+    nonce = nonce or secrets.token_urlsafe(12)
+    return f"{expires}.{nonce}.{_captcha_mac(expires, nonce, text)}"
+
+def captcha_token_nonce(token):
+    """Challenge id carried by a hash_captcha token, or None."""
+    parts = token.split('.') if isinstance(token, str) else ()
+    return parts[1] if len(parts) == 3 else None
 
-def generate_tripcode(post_name, account_name, board_owner, board_staffs):
-    """Generate a tripcode from post name and handle board owner tags."""
+def generate_tripcode(post_name, account_name, board_owner, board_staffs, role=None):
+    """
+    Generate a tripcode from post name and handle board owner tags.
+    role is the poster's account role if the caller already looked it up.
+    """
     # Handle board owner tag (##) first
     if '##' in post_name:
-        existing_user = DB.query('accounts', {'username': {'==': account_name}})
-        if existing_user:
+        role = poster_role(account_name, role)
+        if role is not None:
             if account_name in board_staffs:
                 user_role = 'Board Staff'
                 post_name = post_name.replace('##', f'<span class="user_name_role">{user_role}</span>')
-            if existing_user[0]['role'] == 'mod':
+            if role == 'mod':
                 user_role = 'General Moderator'
                 post_name = post_name.replace('##', f'<span class="user_name_role">{user_role}</span>')
-            elif existing_user[0]['role'] == 'owner':
+            elif role == 'owner':
                 user_role = '!reinchan'
                 post_name = post_name.replace('##', f'<span class="user_name_role">{user_role}</span>')
-            elif existing_user[0]['role'] == '' and account_name == board_owner:
+            elif role == '' and account_name == board_owner:
                 user_role = 'Board Owner'
                 post_name = post_name.replace('##', f'<span class="user_name_role">{user_role}</span>')
-            elif existing_user[0]['role'] == '' or account_name == '':
+            elif role == '' or account_name == '':
                 post_name = post_name.replace('##', '')
     
     # Then handle regular tripcode (#text)
@@ -241,14 +318,25 @@ def verify_password(stored_password, provided_password):
     return hashed_provided.hex() == hashed
 
 def validate_captcha(captcha_input: str, stored_hash: str) -> bool:
-    """Valida o CAPTCHA comparando com hash bcrypt."""
+    """
+    Validate a CAPTCHA answer against a token from hash_captcha. A token is accepted
+    once: used tokens are remembered in the database until they expire.
+    """
     if not captcha_input or not stored_hash:
         return False
 
-    return bcrypt.checkpw(
-        captcha_input.encode('utf-8'),
-        stored_hash.encode('utf-8')
-    )
+    try:
+        expires, nonce, mac = stored_hash.split('.')
+        expires = int(expires)
+    except ValueError:
+        return False
+
+    now = time.time()
+    if expires < now:
+        return False
+    if not hmac.compare_digest(mac, _captcha_mac(expires, nonce, captcha_input)):
+        return False
+    return _claim_captcha_nonce(nonce, expires, now)
 
 def hash_ip(ip):
     if not ip:
@@ -274,12 +362,121 @@ def get_current_datetime():
     """Get current datetime in the site-configured timezone."""
     return datetime.datetime.now(get_site_timezone()).strftime("%d/%m/%Y %H:%M:%S")
 
+# Board Statistics
+def refresh_board_stats(board_uri, db=None):
+    """Recompute the stored counters of a board from posts and replies; db defaults to DB."""
+    db = db or DB
+    thread_ids = [post['post_id'] for post in db.query('posts', {'board': {'==': board_uri}}, columns=['post_id'])]
+    stats = {
+        'board_uri': board_uri,
+        'thread_count': len(thread_ids),
+        'reply_count': 0,
+        'last_activity': None,
+        'last_post_id': None
+    }
+
+    last_post = db.query('posts', {'board': {'==': board_uri}}, sort_by='post_id', sort_desc=True,
+                         limit=1, columns=['post_id', 'post_date'])
+    if last_post:
+        stats['last_post_id'] = last_post[0]['post_id']
+        stats['last_activity'] = last_post[0]['post_date']
+
+    # Chunk the IN lists to stay below SQLite's bound parameter limit.
+    for start in range(0, len(thread_ids), 500):
+        chunk = thread_ids[start:start + 500]
+        stats['reply_count'] += db.count('replies', {'post_id': {'in': chunk}})
+        last_reply = db.query('replies', {'post_id': {'in': chunk}}, sort_by='reply_id', sort_desc=True,
+                              limit=1, columns=['reply_id', 'post_date'])
+        if last_reply and (stats['last_post_id'] is None or last_reply[0]['reply_id'] > stats['last_post_id']):
+            stats['last_post_id'] = last_reply[0]['reply_id']
+            stats['last_activity'] = last_reply[0]['post_date']
+
+    existing = db.query('board_stats', {'board_uri': {'==': board_uri}}, columns=['id'])
+    if existing:
+        db.update('board_stats', existing[0]['id'], stats)
+    else:
+        db.insert('board_stats', stats)
+    return stats
+
+@DB.atomic
+def update_board_stats(board_uri, threads=0, replies=0, post_id=None, post_date=None, removed_ids=()):
+    """
+    Apply counter deltas to a board and record new activity if post_id is given.
+    removed_ids are the numbers of deleted posts/replies: if the board's last
+    activity was one of them, it is recomputed from the remaining rows.
+    """
+    if not board_uri:
+        return
+    new_data = {}
+    advance = None
+    if post_id is not None:
+        new_data = {'last_activity': post_date}
+        advance = ('last_post_id', post_id)
+    updated = DB.increment('board_stats', {'board_uri': {'==': board_uri}},
+                           {'thread_count': threads, 'reply_count': replies}, new_data, advance=advance)
+    if not updated:
+        refresh_board_stats(board_uri)
+    elif removed_ids:
+        stats = DB.query('board_stats', {'board_uri': {'==': board_uri}}, columns=['id', 'last_post_id'])
+        if stats and stats[0]['last_post_id'] in set(removed_ids):
+            DB.update('board_stats', stats[0]['id'], get_board_activity(board_uri))
+
+def get_board_activity(board_uri):
+    """Newest post or reply of a board, from the threads and their last_reply_* counters."""
+    activity = {'last_post_id': None, 'last_activity': None}
+    last_thread = DB.query('posts', {'board': {'==': board_uri}}, sort_by='post_id', sort_desc=True,
+                           limit=1, columns=['post_id', 'post_date'])
+    if last_thread:
+        activity = {'last_post_id': last_thread[0]['post_id'], 'last_activity': last_thread[0]['post_date']}
+    last_reply = DB.query('posts', {'board': {'==': board_uri}, 'last_reply_id': {'!=': None}},
+                          sort_by='last_reply_id', sort_desc=True, limit=1,
+                          columns=['last_reply_id', 'last_reply_at'])
+    if last_reply and (activity['last_post_id'] is None or last_reply[0]['last_reply_id'] > activity['last_post_id']):
+        activity = {'last_post_id': last_reply[0]['last_reply_id'], 'last_activity': last_reply[0]['last_reply_at']}
+    return activity
+
+# Thread Statistics
+THREAD_STATS_COLUMNS = ['post_id', 'reply_count', 'image_count', 'last_reply_id', 'last_reply_at']
+
+def refresh_thread_stats(thread_id):
+    """Recompute the reply counters stored on a thread."""
+    replies = DB.query('replies', {'post_id': {'==': thread_id}}, sort_by='reply_id',
+                       columns=['reply_id', 'post_date', 'images'])
+    stats = {
+        'reply_count': len(replies),
+        'image_count': sum(len(reply.get('images') or []) for reply in replies),
+        'last_reply_id': replies[-1]['reply_id'] if replies else None,
+        'last_reply_at': replies[-1]['post_date'] if replies else None
+    }
+    DB.update_where('posts', {'post_id': {'==': thread_id}}, stats)
+    return stats
+
+def get_last_replies(thread_ids, per_thread=4):
+    """Get the last replies of each thread in one query, oldest first within a thread."""
+    return DB.query_last_per_group('replies', 'post_id', thread_ids, 'reply_id', per_thread)
+
+def get_all_board_stats():
+    """Get the stored counters of every board, keyed by board URI."""
+    return {stats['board_uri']: stats for stats in DB.find_all('board_stats')}
+
+def _apply_board_stats(board, stats):
+    stats = stats or {}
+    board['thread_count'] = stats.get('thread_count') or 0
+    board['total_posts'] = board['thread_count'] + (stats.get('reply_count') or 0)
+    board['last_activity'] = stats.get('last_activity')
+    board['last_post_id'] = stats.get('last_post_id')
+    return board
+
 # Board Operations
+def invalidate_board_cache():
+    """Drop cached board settings in every worker; call after any write to boards."""
+    BOARDS_VERSION.bump()
+
 def verify_board_captcha(board_uri):
     """Check if CAPTCHA is enabled for a board."""
-    board = DB.query('boards', {'board_uri': {'==': board_uri}})
-    if board and 'enable_captcha' in board[0]:
-        return board[0]['enable_captcha'] == 1
+    board = get_board_info(board_uri)
+    if board and 'enable_captcha' in board:
+        return board['enable_captcha'] == 1
     return False
 
 def set_all_boards_captcha(option):
@@ -288,6 +485,7 @@ def set_all_boards_captcha(option):
     for board in boards:
         board['enable_captcha'] = 1 if option == 'enable' else 0
         DB.update('boards', board['id'], board)
+    invalidate_board_cache()
     return True
 
 def set_board_captcha(board_uri, option):
@@ -296,12 +494,33 @@ def set_board_captcha(board_uri, option):
     board = boards[0]
     board['enable_captcha'] = 1 if option == 'enable' else 0
     DB.update('boards', board['id'], board)
+    invalidate_board_cache()
     return True
 
 def get_board_info(board_uri):
-    """Get information about a specific board."""
+    """
+    Get information about a specific board.
+    Served from a per-process LRU cache; callers get their own copy.
+    """
+    global _board_cache_version
+    version = BOARDS_VERSION.current()
+    with _board_cache_lock:
+        if version != _board_cache_version:
+            _board_cache.clear()
+            _board_cache_version = version
+        if board_uri in _board_cache:
+            _board_cache.move_to_end(board_uri)
+            board = _board_cache[board_uri]
+            return copy.copy(board) if board is not None else None
+
     board = DB.query('boards', {'board_uri': {'==': board_uri}})
-    return board[0] if board else None
+    board = board[0] if board else None
+    with _board_cache_lock:
+        if version == _board_cache_version:
+            _board_cache[board_uri] = board
+            if len(_board_cache) > BOARD_CACHE_SIZE:
+                _board_cache.popitem(last=False)
+    return copy.copy(board) if board is not None else None
 
 def get_board_banner(board_uri):
     """Get a random banner for a board."""
@@ -321,7 +540,7 @@ def get_board_banner(board_uri):
     selected_image = random.choice(images)
     return f'/static/imgs/banners/{board_uri}/{selected_image}'
 
-def get_all_posts(include_replies=False, board_filter=None, sort_by_date=False):
+def get_all_posts(include_replies=False, board_filter=None, sort_by_date=False, limit=None):
     """
     Get all posts from the database, optionally filtered by board and including replies.
     Can control whether to sort by date or not.
@@ -330,6 +549,7 @@ def get_all_posts(include_replies=False, board_filter=None, sort_by_date=False):
         include_replies (bool): Whether to include replies in the results
         board_filter (str): Optional board URI to filter posts by
         sort_by_date (bool): Whether to sort posts by date (newest first). Default True.
+        limit (int): Optional maximum number of threads, most recently bumped first
         
     Returns:
         list: List of all posts (and optionally replies) matching the criteria
@@ -340,7 +560,10 @@ def get_all_posts(include_replies=False, board_filter=None, sort_by_date=False):
         if board_filter:
             query['board'] = {'==': board_filter}
         
-        posts = DB.query('posts', query)
+        if limit is not None:
+            posts = DB.query('posts', query, sort_by='bumped_at', sort_desc=True, limit=limit)
+        else:
+            posts = DB.query('posts', query)
         
         if include_replies:
             # Get all replies
@@ -375,45 +598,10 @@ def get_all_boards(include_stats=False):
         boards = DB.find_all('boards')
         
         if include_stats:
+            all_stats = get_all_board_stats()
             for board in boards:
-                board_uri = board['board_uri']
-
                 board['board_isvisible'] = board.get('board_isvisible', 1)
-                
-                # Get all posts for this board
-                posts = DB.query('posts', {
-                    'board': {'==': board_uri}
-                })
-                
-                # Thread count is just the number of posts
-                board['thread_count'] = len(posts)
-                
-                # Get reply count for each post
-                reply_count = 0
-                last_activity = None
-                
-                for post in posts:
-                    # Get replies for this post
-                    replies = DB.query('replies', {
-                        'post_id': {'==': post['post_id']}
-                    })
-                    
-                    reply_count += len(replies)
-                    
-                    # Check for last activity in replies
-                    for reply in replies:
-                        if not last_activity or reply['post_date'] > last_activity:
-                            last_activity = reply['post_date']
-                
-                # Total posts is threads + replies
-                board['total_posts'] = board['thread_count'] + reply_count
-                
-                # Check for last activity in posts
-                for post in posts:
-                    if not last_activity or post['post_date'] > last_activity:
-                        last_activity = post['post_date']
-                
-                board['last_activity'] = last_activity
+                _apply_board_stats(board, all_stats.get(board['board_uri']))
         
         return boards
     
@@ -440,44 +628,18 @@ def get_board_stats(board_uri):
     }
     
     try:
-        # Get thread count
-        stats['thread_count'] = len(DB.query('posts', {
-            'board': {'==': board_uri}
-        }))
-        
-        # Get reply count
-        thread_ids = [post['post_id'] for post in DB.query('posts', {
-            'board': {'==': board_uri}
-        })]
-        
-        if thread_ids:
-            stats['reply_count'] = len(DB.query('replies', {
-                'post_id': {'in': thread_ids}
-            }))
-        
+        stored = DB.query('board_stats', {'board_uri': {'==': board_uri}})
+        stored = stored[0] if stored else refresh_board_stats(board_uri)
+
+        stats['thread_count'] = stored.get('thread_count') or 0
+        stats['reply_count'] = stored.get('reply_count') or 0
         stats['total_posts'] = stats['thread_count'] + stats['reply_count']
+        stats['last_activity'] = stored.get('last_activity')
         
         # Get pinned threads count
-        stats['pinned_threads'] = len(DB.query('pinned', {
+        stats['pinned_threads'] = DB.count('pinned', {
             'board': {'==': board_uri}
-        }))
-        
-        # Get last activity
-        last_post = DB.query('posts', {
-            'board': {'==': board_uri}
-        }, sort_by='post_date', sort_desc=True, limit=1)
-        
-        last_reply = None
-        if thread_ids:
-            last_reply = DB.query('replies', {
-                'post_id': {'in': thread_ids}
-            }, sort_by='post_date', sort_desc=True, limit=1)
-        
-        if last_post:
-            stats['last_activity'] = last_post[0]['post_date']
-        if last_reply:
-            if not stats['last_activity'] or last_reply[0]['post_date'] > stats['last_activity']:
-                stats['last_activity'] = last_reply[0]['post_date']
+        })
         
         return stats
     
@@ -534,23 +696,28 @@ def get_popular_boards(limit=5):
         list: List of popular boards with activity stats
     """
     try:
-        all_boards = get_all_boards(include_stats=True)
+        # Most recent activity first; post numbers are global and increasing
+        active_stats = DB.query('board_stats', {'last_post_id': {'!=': None}},
+                                sort_by='last_post_id', sort_desc=True, limit=limit)
+        active_boards = []
+        for stats in active_stats:
+            board = get_board_info(stats['board_uri'])
+            if board:
+                active_boards.append(_apply_board_stats(board, stats))
         
-        # Filter boards with activity and sort by last activity
-        active_boards = [b for b in all_boards if b.get('last_activity')]
-        active_boards.sort(key=lambda x: x['last_activity'], reverse=True)
-        
-        return active_boards[:limit]
+        return active_boards
     
     except Exception as e:
         print(f"Error getting popular boards: {e}")
         return []
 
 def get_max_post_id():
-    max_post_id = max([post['post_id'] for post in DB.find_all('posts')] + [0]) 
-    max_reply_id = max([reply['reply_id'] for reply in DB.find_all('replies')] + [0])
-    max_id = max(max_post_id, max_reply_id)
-    return max_id
+    """Get the last public post number handed out."""
+    return DB.current_sequence_value(POST_SEQUENCE)
+
+def next_post_id():
+    """Atomically reserve the next public post number."""
+    return DB.next_sequence_value(POST_SEQUENCE)
 
 def get_post_info(post_id):
     """Get post information by post ID, excluding the poster's IP."""
@@ -561,11 +728,11 @@ def get_post_info(post_id):
     post = DB.query('posts', {'post_id': {'==': post_id}})
     replies = DB.query('replies', {'reply_id': {'==': post_id}})
     if post:
-        post_copy = dict(post[0])
+        post_copy = post[0].to_dict()
         post_copy.pop('user_ip', None)
         return post_copy
     elif replies:
-        reply_copy = dict(replies[0])
+        reply_copy = replies[0].to_dict()
         reply_copy.pop('user_ip', None)
         return reply_copy
     return None
@@ -573,8 +740,8 @@ def get_post_info(post_id):
 def get_post_ip(post_id):
     """Get the IP address of a post or reply."""
     post_id = int(post_id)
-    post = DB.query('posts', {'post_id': {'==': post_id}})
-    replies = DB.query('replies', {'reply_id': {'==': post_id}})
+    post = DB.query('posts', {'post_id': {'==': post_id}}, columns=['user_ip'])
+    replies = DB.query('replies', {'reply_id': {'==': post_id}}, columns=['user_ip'])
     if post:
         return post[0].get('user_ip')
     elif replies:
@@ -605,18 +772,13 @@ def add_new_board(board_uri, board_name, board_description, username, captcha_in
     if board_uri.lower() in reserved_uris:
         return False
     
-    existing_boards = DB.query('boards', {'board_uri': {'==': board_uri}})
-    if existing_boards:
+    if DB.exists('boards', {'board_uri': {'==': board_uri}}):
         return False
     
     if len(board_uri) < 1 or len(board_name) < 1 or len(board_description) <= 3:
         return False
     
-    max_board_id = max([board['id'] for board in DB.find_all('boards')] + [0])
-    new_board_id = max_board_id + 1
-    
     new_board = {
-        'id': new_board_id,
         'board_owner': username,
         'board_staffs': [],
         'board_uri': board_uri,
@@ -635,7 +797,12 @@ def add_new_board(board_uri, board_name, board_description, username, captcha_in
         'board_lang': 'default'
     }
     
-    DB.insert('boards', new_board)
+    try:
+        DB.insert('boards', new_board, on_conflict='abort')
+    except sqlite3.IntegrityError:
+        return False  # Created concurrently under the same uri.
+    invalidate_board_cache()
+    refresh_board_stats(board_uri)
     create_banner_folder(board_uri)
     return True
 
@@ -646,6 +813,7 @@ def hide_board(board_uri):
         return False
     
     DB.update('boards', board_info['id'], {'board_isvisible': 0})
+    invalidate_board_cache()
     return True
 
 def unhide_board(board_uri):
@@ -655,6 +823,7 @@ def unhide_board(board_uri):
         return False
     
     DB.update('boards', board_info['id'], {'board_isvisible': 1})
+    invalidate_board_cache()
     return True
 
 def edit_board_info(board_uri, new_board_owner, new_board_name, new_board_desc, new_board_tag, require_media_approval=None,
@@ -738,8 +907,10 @@ def edit_board_info(board_uri, new_board_owner, new_board_name, new_board_desc,
         update_data['board_lang'] = board_lang_value
 
     DB.update('boards', board_info['id'], update_data)
+    invalidate_board_cache()
     return True
 
+@DB.atomic
 def remove_board(board_uri, username, role):
     """Remove a board."""
     board_info = get_board_info(board_uri)
@@ -749,13 +920,15 @@ def remove_board(board_uri, username, role):
     if board_info.get('board_owner') != username and 'mod' not in role.lower() and 'owner' not in role.lower():
         return False
     
-    # Remove all posts from this board
-    posts = DB.query('posts', {'board': {'==': board_uri}})
+    # Remove all posts from this board, then the board, in one transaction
+    posts = DB.query('posts', {'board': {'==': board_uri}}, columns=['post_id'])
     for post in posts:
         remove_post(post['post_id'])
-    
-    # Remove the board
+
     DB.delete('boards', board_info['id'])
+    DB.delete_where('board_stats', {'board_uri': {'==': board_uri}})
+    DB.delete_where('board_staff', {'board_uri': {'==': board_uri}})
+    invalidate_board_cache()
     return True
 
 def add_board_staff(board_uri, username):
@@ -789,7 +962,10 @@ def add_board_staff(board_uri, username):
     board["board_staffs"].append(username)
 
     # Update in the database
-    DB.update("boards", board["id"], board)
+    with DB.transaction():
+        DB.update("boards", board["id"], board)
+        DB.insert("board_staff", {"board_uri": board_uri, "username": username})
+        invalidate_board_cache()
 
     return True
 
@@ -824,7 +1000,10 @@ def remove_board_staff(board_uri, username):
     board["board_staffs"].remove(username)
 
     # Update in the database
-    DB.update("boards", board["id"], board)
+    with DB.transaction():
+        DB.update("boards", board["id"], board)
+        DB.delete_where("board_staff", {"board_uri": {"==": board_uri}, "username": {"==": username}})
+        invalidate_board_cache()
 
     return True
 
@@ -842,217 +1021,254 @@ def register_user(username, password, captcha_input, captcha_text):
     if not validate_captcha(captcha_input, captcha_text) or len(username) <= 3:
         return False
     
-    existing_user = DB.query('accounts', {'username': {'==': username}})
-    if existing_user:
+    if DB.exists('accounts', {'username': {'==': username}}):
         return False
     
     hashed_password = hash_password(password)
-    role = 'owner' if len(DB.find_all('accounts')) == 0 else ''
+    role = 'owner' if not DB.exists('accounts') else ''
     
-    max_account_id = max([account['id'] for account in DB.find_all('accounts')] + [0])
     new_user = {
-        'id': max_account_id + 1,
         'username': username,
         'password': hashed_password,
         'role': role
     }
     
-    DB.insert('accounts', new_user)
+    try:
+        DB.insert('accounts', new_user, on_conflict='abort')
+    except sqlite3.IntegrityError:
+        return False  # Registered concurrently under the same name.
+    ACCOUNTS_VERSION.bump()
     return True
 
 def get_user_role(username):
     """Get a user's role."""
-    user = DB.query('accounts', {'username': {'==': username}})
+    user = DB.query('accounts', {'username': {'==': username}}, columns=['role'])
     return user[0]['role'] if user else None
 
+def _build_user_acl(username):
+    role = get_user_role(username)
+    roles_lower = (role or '').lower()
+    owned = frozenset(board['board_uri'] for board in
+                      DB.query('boards', {'board_owner': {'==': username}}, columns=['board_uri']))
+    staffed = frozenset(staff['board_uri'] for staff in
+                        DB.query('board_staff', {'username': {'==': username}}, columns=['board_uri']))
+    return {
+        'role': role,
+        'is_global_staff': 'owner' in roles_lower or 'mod' in roles_lower,
+        'owned_boards': owned,
+        'staff_boards': staffed,
+        'boards': owned | staffed
+    }
+
+def get_user_acl(username):
+    """
+    A user's global role and the boards they own or staff:
+    {'role', 'is_global_staff', 'owned_boards', 'staff_boards', 'boards'}.
+    Served from a per-process LRU cache that is dropped on any role, owner
+    or staff change. The board sets are frozensets, so the result is shared.
+    """
+    global _acl_cache_version
+    version = (BOARDS_VERSION.current(), ACCOUNTS_VERSION.current())
+    with _acl_cache_lock:
+        if version != _acl_cache_version:
+            _acl_cache.clear()
+            _acl_cache_version = version
+        if username in _acl_cache:
+            _acl_cache.move_to_end(username)
+            return _acl_cache[username]
+
+    acl = _build_user_acl(username)
+    with _acl_cache_lock:
+        if version == _acl_cache_version:
+            _acl_cache[username] = acl
+            if len(_acl_cache) > ACL_CACHE_SIZE:
+                _acl_cache.popitem(last=False)
+    return acl
+
+def poster_role(account_name, role=None):
+    """The poster's account role: role if the caller already has it, else from get_user_acl."""
+    if role is None and account_name:
+        role = get_user_acl(account_name)['role']
+    return role
+
 def get_post_board(post_id):
     """Get the info from post."""
     post_id = int(post_id)
-    post = DB.query('posts', {'post_id': {'==': post_id}})
+    post = DB.query('posts', {'post_id': {'==': post_id}}, columns=['board'])
     if post:
         return post[0]['board']
 
-    reply = DB.query('replies', {'reply_id': {'==': post_id}})
+    reply = DB.query('replies', {'reply_id': {'==': post_id}}, columns=['post_id'])
     if reply:
-        post = DB.query('posts', {'post_id': {'==': reply[0]['post_id']}})
+        post = DB.query('posts', {'post_id': {'==': reply[0]['post_id']}}, columns=['board'])
         return post[0]['board'] if post else None
     
     return None
 
 def check_user_exists(username):
     """Check if a user exists."""
-    user = DB.query('accounts', {'username': {'==': username}})
-    return True if user else False
+    return DB.exists('accounts', {'username': {'==': username}})
 
 def check_post_exist(post_id):
     """Verify if thread exists."""
-    post = DB.query('posts', {'post_id': {'==': post_id}})
-    if not post:
-        reply = DB.query('replies', {'reply_id': {'==': post_id}})
-        return True if reply else False
+    if not DB.exists('posts', {'post_id': {'==': post_id}}):
+        return DB.exists('replies', {'reply_id': {'==': post_id}})
     return True
 
 def check_replyto_exist(post_id):
     """Verify if reply_to thread exists."""
-    post = DB.query('posts', {'post_id': {'==': post_id}})
-    return True if post else False
+    return DB.exists('posts', {'post_id': {'==': post_id}})
 
 # Post Operations
+@DB.atomic
 def bump_thread(thread_id):
     """
-    Bump a thread by deleting and recreating for keep the thread new on DB.
-    This brings the thread to the end of the database (making it appear first in descending order).
+    Bump a thread by moving its bumped_at to the top of the bump sequence.
+    This makes it appear first on its board page. The sequence value is taken
+    in the same transaction as the update, so a failed bump leaves no gap.
     
     Args:
         thread_id (int): The ID of the thread to bump
         
     Returns:
-        bool: True if successful, False otherwise
+        bool: True if the thread exists and was bumped
     """
-    try:
-        # Remove the thread from DB.
-        thread = DB.query('posts', {'post_id': {'==': thread_id}})
-        if not thread:
-            return False
-        
-        thread = thread[0]
-        DB.delete('posts', thread['id'])
-        
-        # Finally insert again.
-        if 'id' in thread:
-            del thread['id']
-        DB.insert('posts', thread)
-        
-        return True
-    
-    except Exception as e:
-        print(f"Error bumping thread {thread_id}: {e}")
-        return False
+    updated = DB.update_where('posts', {'post_id': {'==': thread_id}},
+                              {'bumped_at': DB.next_sequence_value(BUMP_SEQUENCE)})
+    return updated > 0
 
-def add_new_post(user_ip, account_name, board_id, post_subject, post_name, original_content, comment, embed, files):
-    """Create a new post"""
+@DB.atomic
+def add_new_post(user_ip, account_name, board_id, post_subject, post_name, original_content, comment, embed, files,
+                 post_id=None, role=None):
+    """
+    Create a new post; post_id is a number already taken from next_post_id()
+    and role the poster's account role, if the caller has them. The post and
+    the board counters are written as one unit of work.
+    """
     # First verify if board exists
-    board = DB.query('boards', {'board_uri': {'==': board_id}})
-    board_owner = board[0]['board_owner']
-    board_staffs = board[0]['board_staffs']
+    board = get_board_info(board_id)
+    if not board:
+        raise ValueError(f"Board '{board_id}' does not exist")
+
+    board_owner = board['board_owner']
+    board_staffs = board['board_staffs']
     try:
-        require_media_approval = int(board[0].get('require_media_approval', 0))
+        require_media_approval = int(board.get('require_media_approval', 0))
     except (ValueError, TypeError):
         require_media_approval = 0
-
-    if not board:
-        raise ValueError(f"Board '{board_id}' does not exist")
     
-    with POST_LOCK:
-        # Get the next post ID
-        max_post_id = max([post['post_id'] for post in DB.find_all('posts')] + [0]) 
-        max_reply_id = max([reply['reply_id'] for reply in DB.find_all('replies')] + [0])
-        max_id = max(max_post_id, max_reply_id)
-        new_post_id = max_id + 1
-
-        # Check media approval
-        media_approved = 1
-        if files and require_media_approval == 1:
-            is_privileged = False
-            if account_name == board_owner:
-                is_privileged = True
-            elif account_name in board_staffs:
-                is_privileged = True
-            else:
-                 user = DB.query('accounts', {'username': {'==': account_name}})
-                 if user:
-                     role = user[0]['role'].lower()
-                     if 'mod' in role or 'owner' in role:
-                         is_privileged = True
-            
-            if not is_privileged:
-                media_approved = 0
-            
-        # Create the new post
-        new_post = {
-            # 'id': new_post_id, # Let SQLite handle the ID
-            'user_ip': user_ip,
-            'post_id': new_post_id,
-            'post_user': generate_tripcode(post_name, account_name, board_owner, board_staffs),
-            'post_subject': post_subject,
-            'post_date': get_current_datetime(),
-            'board': board_id,
-            'original_content': original_content,
-            'post_content': comment,
-            'post_images': files, 
-            'locked': 0,
-            'visible': 1,
-            'media_approved': media_approved
-        }
+    # Reserve the next public post number
+    new_post_id = post_id if post_id is not None else next_post_id()
+
+    # Check media approval
+    media_approved = 1
+    if files and require_media_approval == 1:
+        is_privileged = False
+        if account_name == board_owner:
+            is_privileged = True
+        elif account_name in board_staffs:
+            is_privileged = True
+        else:
+             roles = (poster_role(account_name, role) or '').lower()
+             if 'mod' in roles or 'owner' in roles:
+                 is_privileged = True
+        
+        if not is_privileged:
+            media_approved = 0
         
-        # Insert into database
-        DB.insert('posts', new_post)
+    # Create the new post
+    new_post = {
+        # 'id': new_post_id, # Let SQLite handle the ID
+        'user_ip': user_ip,
+        'post_id': new_post_id,
+        'post_user': generate_tripcode(post_name, account_name, board_owner, board_staffs, role),
+        'post_subject': post_subject,
+        'post_date': get_current_datetime(),
+        'board': board_id,
+        'original_content': original_content,
+        'post_content': comment,
+        'post_images': files, 
+        'locked': 0,
+        'visible': 1,
+        'media_approved': media_approved,
+        'bumped_at': DB.next_sequence_value(BUMP_SEQUENCE),
+        'reply_count': 0,
+        'image_count': 0
+    }
+    
+    # Insert into database
+    DB.insert('posts', new_post)
+    update_board_stats(board_id, threads=1, post_id=new_post_id, post_date=new_post['post_date'])
     return new_post_id
 
-def add_new_reply(user_ip, account_name, post_subject, reply_to, post_name, comment, embed, files):
-    """Add a reply to a post with multiple files."""
+@DB.atomic
+def add_new_reply(user_ip, account_name, post_subject, reply_to, post_name, comment, embed, files, reply_id=None,
+                  role=None):
+    """
+    Add a reply to a post with multiple files; reply_id is a number already
+    taken from next_post_id() and role the poster's account role, if the
+    caller has them. The reply, the bump and the thread and board counters
+    are written as one unit of work.
+    """
     existing_post = DB.query('posts', {'post_id': {'==': int(reply_to)}})
-    board = DB.query('boards', {'board_uri': {'==': existing_post[0]['board']}})
-    board_owner = board[0]['board_owner']
-    board_staffs = board[0]['board_staffs']
+    board = get_board_info(existing_post[0]['board'])
+    board_owner = board['board_owner']
+    board_staffs = board['board_staffs']
     try:
-        require_media_approval = int(board[0].get('require_media_approval', 0))
+        require_media_approval = int(board.get('require_media_approval', 0))
     except (ValueError, TypeError):
         require_media_approval = 0
 
-    with POST_LOCK:
-        max_post_id = max([post['post_id'] for post in DB.find_all('posts')] + [0]) 
-        max_reply_id = max([reply['reply_id'] for reply in DB.find_all('replies')] + [0])
-        max_id = max(max_post_id, max_reply_id)
-        new_reply_id = max_id + 1
-
-        # Check media approval
-        media_approved = 1
-        if files and require_media_approval == 1:
-            is_privileged = False
-            if account_name == board_owner:
-                is_privileged = True
-            elif account_name in board_staffs:
-                is_privileged = True
-            else:
-                 user = DB.query('accounts', {'username': {'==': account_name}})
-                 if user:
-                     role = user[0]['role'].lower()
-                     if 'mod' in role or 'owner' in role:
-                         is_privileged = True
-            
-            if not is_privileged:
-                media_approved = 0
-
-        new_reply = {
-            'id': new_reply_id,
-            'user_ip': user_ip,
-            'reply_id': new_reply_id,
-            'post_id': int(reply_to),
-            'post_user': generate_tripcode(post_name, account_name, board_owner, board_staffs),
-            'post_subject': post_subject,
-            'post_date': get_current_datetime(),
-            'content': comment,
-            'images': files,
-            'media_approved': media_approved
-        }
-        if not 'sage' in post_subject.lower():
-            bump_thread(int(reply_to))
-        DB.insert('replies', new_reply)
+    new_reply_id = reply_id if reply_id is not None else next_post_id()
+
+    # Check media approval
+    media_approved = 1
+    if files and require_media_approval == 1:
+        is_privileged = False
+        if account_name == board_owner:
+            is_privileged = True
+        elif account_name in board_staffs:
+            is_privileged = True
+        else:
+             roles = (poster_role(account_name, role) or '').lower()
+             if 'mod' in roles or 'owner' in roles:
+                 is_privileged = True
+        
+        if not is_privileged:
+            media_approved = 0
+
+    new_reply = {
+        'id': new_reply_id,
+        'user_ip': user_ip,
+        'reply_id': new_reply_id,
+        'post_id': int(reply_to),
+        'post_user': generate_tripcode(post_name, account_name, board_owner, board_staffs, role),
+        'post_subject': post_subject,
+        'post_date': get_current_datetime(),
+        'content': comment,
+        'images': files,
+        'media_approved': media_approved
+    }
+    DB.insert('replies', new_reply)
+    if not 'sage' in post_subject.lower():
+        bump_thread(int(reply_to))
+    DB.increment('posts', {'post_id': {'==': int(reply_to)}},
+                 {'reply_count': 1, 'image_count': len(files or [])},
+                 {'last_reply_at': new_reply['post_date']}, advance=('last_reply_id', new_reply_id))
+    update_board_stats(existing_post[0]['board'], replies=1, post_id=new_reply_id,
+                       post_date=new_reply['post_date'])
     
     return new_reply_id
 
 def get_all_registered_users(offset=0, limit=20, search_query=None):
     """Get all registered users with pagination and optional search."""
     try:
-        all_users = DB.find_all('accounts')
-        
-        if search_query:
-            search_query = search_query.lower()
-            all_users = [u for u in all_users if search_query in u.get('username', '').lower()]
-            
-        # Sort by id
-        all_users.sort(key=lambda x: x.get('id', 0)) 
+        if not search_query:
+            return DB.find_all('accounts', sort_by='id', limit=limit, offset=offset)
+
+        all_users = DB.find_all('accounts', sort_by='id')
+        search_query = search_query.lower()
+        all_users = [u for u in all_users if search_query in u.get('username', '').lower()]
         return all_users[offset:offset+limit]
     except Exception as e:
         print(f"Error getting users: {e}")
@@ -1061,12 +1277,12 @@ def get_all_registered_users(offset=0, limit=20, search_query=None):
 def count_all_registered_users(search_query=None):
     """Count all registered users with optional search."""
     try:
+        if not search_query:
+            return DB.count('accounts')
+
         all_users = DB.find_all('accounts')
-        
-        if search_query:
-            search_query = search_query.lower()
-            all_users = [u for u in all_users if search_query in u.get('username', '').lower()]
-            
+        search_query = search_query.lower()
+        all_users = [u for u in all_users if search_query in u.get('username', '').lower()]
         return len(all_users)
     except Exception as e:
         print(f"Error counting users: {e}")
@@ -1080,6 +1296,7 @@ def update_user_role(username, new_role):
             return False
         user = users[0]
         DB.update('accounts', user['id'], {'role': new_role})
+        ACCOUNTS_VERSION.bump()
         return True
     except Exception as e:
         print(f"Error updating user role: {e}")
@@ -1099,6 +1316,8 @@ def move_thread(thread_id, new_board_uri: str):
 
     # Atualizar board da thread
     DB.update('posts', thread[0]['id'], {'board': new_board_uri})
+    refresh_board_stats(thread[0]['board'])
+    refresh_board_stats(new_board_uri)
 
     # Atualizar pinned se existir
     pinned = DB.query('pinned', {'post_id': {'==': int(thread_id)}})
@@ -1130,62 +1349,87 @@ def delete_media_files(file_list, base_path, is_video=False):
                 thumb_path = os.path.join(base_path, 'thumbs', thumb_name)
                 if os.path.exists(thumb_path):
                     os.remove(thumb_path)
+            elif filename.lower().endswith(thumbnail_module.IMAGE_EXTENSIONS):
+                thumbnail_module.delete_thumbnails(base_path, filename)
         except Exception as e:
             print(f"Error deleting file {filename}: {e}")
 
+@DB.atomic
 def remove_post(post_id):
     """Remove a post, its replies, and all associated media files."""
-    # Remove main post and its media
-    post = DB.query('posts', {'post_id': {'==': post_id}})
+    # Remove main post
+    post = DB.query('posts', {'post_id': {'==': post_id}}, columns=['id', 'post_images', 'board'])
     if post:
         post = post[0]
-        # Delete all associated media files
-        delete_media_files(post.get('post_images', []), './static/post_images/', is_video=True)
         DB.delete('posts', post['id'])
-    
+
     # Remove from pinned posts
-    pinned_posts = DB.query('pinned', {'post_id': {'==': post_id}})
-    for pinned in pinned_posts:
-        DB.delete('pinned', pinned['id'])
-    
-    # Remove all replies and their media
-    replies = DB.query('replies', {'post_id': {'==': post_id}})
+    DB.delete_where('pinned', {'post_id': {'==': post_id}})
+
+    # Remove all replies
+    replies = DB.query('replies', {'post_id': {'==': post_id}}, columns=['id', 'reply_id', 'images'])
+    DB.delete_many('replies', [reply['id'] for reply in replies])
+
+    if post:
+        update_board_stats(post['board'], threads=-1, replies=-len(replies),
+                           removed_ids=[post_id] + [reply['reply_id'] for reply in replies])
+
+    # Media files go only once the rows are gone for good, i.e. after the
+    # outermost transaction commits when this runs inside another one.
+    DB.on_commit(lambda: _delete_post_media(post, replies))
+
+    return True
+
+def _delete_post_media(post, replies):
+    if post:
+        delete_media_files(post.get('post_images', []), './static/post_images/', is_video=True)
     for reply in replies:
         delete_media_files(reply.get('images', []), './static/reply_images/')
-        DB.delete('replies', reply['id'])
-    
-    return True
 
+@DB.atomic
 def delete_all_posts_from_user(user_ip, board_uri):
     """Remove all posts and replies made by a specific IP on a specific board."""
     # 1. Delete user's threads
-    user_posts = DB.query('posts', {'user_ip': {'==': user_ip}})
+    user_posts = DB.query('posts', {'user_ip': {'==': user_ip}, 'board': {'==': board_uri}},
+                          columns=['post_id'])
     for post in user_posts:
-        if post.get('board') == board_uri:
-            remove_post(post['post_id'])
-
-    # 2. Delete user's replies in other threads
-    user_replies = DB.query('replies', {'user_ip': {'==': user_ip}})
-    for reply in user_replies:
-        # Check parent thread's board
-        parent_post = DB.query('posts', {'post_id': {'==': reply['post_id']}})
-        if parent_post and parent_post[0].get('board') == board_uri:
-            remove_reply(reply['reply_id'])
-            
+        remove_post(post['post_id'])
+
+    # 2. Delete user's replies in other threads of this board
+    user_replies = DB.query('replies', {'user_ip': {'==': user_ip}}, columns=['id', 'reply_id', 'post_id', 'images'])
+    thread_ids = list({reply['post_id'] for reply in user_replies})
+    board_threads = set()
+    for start in range(0, len(thread_ids), DB.BATCH_SIZE):
+        chunk = thread_ids[start:start + DB.BATCH_SIZE]
+        parents = DB.query('posts', {'post_id': {'in': chunk}, 'board': {'==': board_uri}}, columns=['post_id'])
+        board_threads.update(parent['post_id'] for parent in parents)
+
+    board_replies = [reply for reply in user_replies if reply['post_id'] in board_threads]
+    if board_replies:
+        DB.delete_many('replies', [reply['id'] for reply in board_replies])
+        for thread_id in board_threads:
+            refresh_thread_stats(thread_id)
+        update_board_stats(board_uri, replies=-len(board_replies),
+                           removed_ids=[reply['reply_id'] for reply in board_replies])
+        DB.on_commit(lambda: _delete_post_media(None, board_replies))
+
     return True
 
+@DB.atomic
 def remove_reply(reply_id):
     """Remove a reply."""
     reply = DB.query('replies', {'reply_id': {'==': reply_id}})
     if reply:
         reply = reply[0]
+        DB.delete('replies', reply['id'])
+        refresh_thread_stats(reply['post_id'])
+        update_board_stats(get_post_board(reply['post_id']), replies=-1, removed_ids=[reply['reply_id']])
+
         # Check if post has an associated image
         if reply.get('images'):
-            delete_media_files(reply.get('images', []), './static/reply_images/')
+            DB.on_commit(lambda: delete_media_files(reply.get('images', []), './static/reply_images/'))
         elif reply.get('image'): # Legacy check
-             delete_media_files([reply.get('image')], './static/reply_images/')
-
-        DB.delete('replies', reply['id'])
+            DB.on_commit(lambda: delete_media_files([reply.get('image')], './static/reply_images/'))
 
         return True
 
@@ -1232,6 +1476,7 @@ def delete_media_from_post(thread_id):
         delete_media_files(images, './static/reply_images/')
         post_record['images'] = []
         DB.update('replies', post_record['id'], post_record)
+        refresh_thread_stats(post_record['post_id'])
 
     else:
         images = post_record.get('post_images', [])
@@ -1354,7 +1599,7 @@ def get_pending_media(board_uri=None):
     
     filtered_replies = []
     for reply in pending_replies:
-        post = DB.query('posts', {'post_id': {'==': reply['post_id']}})
+        post = DB.query('posts', {'post_id': {'==': reply['post_id']}}, columns=['board'])
         if post:
             if board_uri and post[0]['board'] != board_uri:
                 continue
@@ -1366,17 +1611,69 @@ def get_pending_media(board_uri=None):
 # Query Operations
 def load_db_page(board_id, offset=0, limit=10):
     """Load paginated posts for a board."""
-    posts = DB.query('posts', {'board': {'==': board_id}})
-    return posts[::-1][offset:offset + limit]
+    return DB.query('posts', {'board': {'==': board_id}}, sort_by='bumped_at', sort_desc=True,
+                    limit=limit, offset=offset)
+
+@DB.atomic
+def prune_board_threads(board_uri, max_threads):
+    """Delete the oldest threads of a board beyond max_threads, with their replies."""
+    posts_for_board = DB.query('posts', {'board': {'==': board_uri}}, sort_by='post_id',
+                               columns=['id', 'post_id', 'last_reply_id'])
+    if len(posts_for_board) <= max_threads:
+        return 0
+    overflow_posts = posts_for_board[:-max_threads] if max_threads > 0 else posts_for_board
+    old_post_ids = [post['post_id'] for post in overflow_posts if post.get('post_id') is not None]
+    removed_replies = 0
+    for start in range(0, len(old_post_ids), DB.BATCH_SIZE):
+        chunk = old_post_ids[start:start + DB.BATCH_SIZE]
+        removed_replies += DB.delete_where('replies', {'post_id': {'in': chunk}})
+    DB.delete_many('posts', [post['id'] for post in overflow_posts])
+    # The board's last activity can only be a pruned thread or its last reply.
+    removed_ids = old_post_ids + [post['last_reply_id'] for post in overflow_posts if post.get('last_reply_id')]
+    update_board_stats(board_uri, threads=-len(overflow_posts), replies=-removed_replies,
+                       removed_ids=removed_ids)
+    return len(overflow_posts)
 
 def count_posts_in_board(board_id):
     """Count total number of posts in a board."""
-    posts = DB.query('posts', {'board': {'==': board_id}})
-    return len(posts)
+    return DB.count('posts', {'board': {'==': board_id}})
+
+def get_thread_replies(thread_id):
+    """Get all replies of a thread in posting order."""
+    return DB.query('replies', {'post_id': {'==': thread_id}}, sort_by='reply_id')
+
+def get_thread_replies_window(thread_id, last, before=None):
+    """
+    Get the last replies of a thread, optionally only those older than the
+    reply number before (a cursor for loading earlier replies).
+
+    Returns:
+        tuple: (replies in posting order, number of earlier replies not returned)
+    """
+    conditions = {'post_id': {'==': thread_id}}
+    if before is not None:
+        conditions['reply_id'] = {'<': before}
+    replies = DB.query('replies', conditions, sort_by='reply_id', sort_desc=True, limit=last)
+    replies.reverse()
+    if not replies:
+        return replies, 0
+    earlier_count = DB.count('replies', {
+        'post_id': {'==': thread_id},
+        'reply_id': {'<': replies[0]['reply_id']}
+    })
+    return replies, earlier_count
 
 def get_pinned_posts(board_uri):
-    """Get pinned posts for a board."""
-    return DB.query('pinned', {'board': {'==': board_uri}})
+    """Get pinned posts for a board, with their thread reply counters."""
+    pinneds = DB.query('pinned', {'board': {'==': board_uri}})
+    if pinneds:
+        threads = DB.query('posts', {'post_id': {'in': [pinned['post_id'] for pinned in pinneds]}},
+                           columns=THREAD_STATS_COLUMNS)
+        counters = {thread['post_id']: thread for thread in threads}
+        for pinned in pinneds:
+            for col in THREAD_STATS_COLUMNS[1:]:
+                pinned[col] = counters.get(pinned['post_id'], {}).get(col)
+    return pinneds
 
 def get_user_boards(username):
     """Get all boards owned by a user."""
@@ -1434,5 +1731,56 @@ def delete_board_banner(board_uri, banner_filename):
             return False
     return False
 
+# Schema migrations, applied once per database and recorded in schema_version.
+def _migrate_sequences(db):
+    db.create_sequence(POST_SEQUENCE, start=lambda: max(
+        db.max('posts', 'post_id', default=0),
+        db.max('replies', 'reply_id', default=0)
+    ))
+    db.create_sequence(BUMP_SEQUENCE, start=lambda: db.max('posts', 'id', default=0))
+
+def _migrate_bumped_at(db):
+    # Older threads keep their insertion (rowid) order.
+    db.execute("UPDATE posts SET bumped_at = id WHERE bumped_at IS NULL")
+
+def _migrate_thread_stats(db):
+    db.execute("""
+        UPDATE posts SET
+            reply_count = (SELECT COUNT(*) FROM replies r WHERE r.post_id = posts.post_id),
+            image_count = (SELECT COALESCE(SUM(CASE WHEN json_valid(r.images) THEN json_array_length(r.images) END), 0)
+                           FROM replies r WHERE r.post_id = posts.post_id),
+            last_reply_id = (SELECT MAX(r.reply_id) FROM replies r WHERE r.post_id = posts.post_id),
+            last_reply_at = (SELECT r.post_date FROM replies r WHERE r.post_id = posts.post_id
+                             ORDER BY r.reply_id DESC LIMIT 1)
+        WHERE reply_count IS NULL
+    """)
+
+def _migrate_board_stats(db):
+    for board in db.find_all('boards', columns=['board_uri']):
+        if not db.exists('board_stats', {'board_uri': {'==': board['board_uri']}}):
+            refresh_board_stats(board['board_uri'], db)
+
+def _migrate_board_staff(db):
+    db.sync_table('board_staff')
+    db.execute("""
+        INSERT OR IGNORE INTO board_staff (board_uri, username)
+        SELECT b.board_uri, s.value FROM boards b, json_each(b.board_staffs) s
+        WHERE json_valid(b.board_staffs) AND s.type = 'text'
+    """)
+    db.create_sequence(ACCOUNTS_VERSION.name)
+
+MIGRATIONS = [
+    (1, 'create tables, columns and indexes', lambda db: db.sync_tables()),
+    (2, 'post number and bump sequences', _migrate_sequences),
+    (3, 'backfill posts.bumped_at', _migrate_bumped_at),
+    (4, 'backfill thread reply counters', _migrate_thread_stats),
+    (5, 'backfill board_stats', _migrate_board_stats),
+    (6, 'board settings version counter', lambda db: db.create_sequence(BOARDS_VERSION.name)),
+    (7, 'board_staff mapping and account version counter', _migrate_board_staff),
+    (8, 'captcha_used table', lambda db: db.sync_table('captcha_used')),
+]
+
+DB.migrate(MIGRATIONS)
+
 if __name__ == '__main__':
     print('This module should not be run directly.')
@@ -1,23 +1,102 @@
 """
 Imageboard Language Management, to manage the entire IB language.
 Handles admin's choosen language.
+
+Language packs live either in ./config/languages.json ({locale: [pack]}) or,
+when the ./config/languages/ directory exists, one ./config/languages/<locale>.json
+per locale holding that locale's [pack] (see split_langs). Parsed files are kept
+in memory and re-read only when their modification time or size changes.
 """
 
 import json
+import os
+import re
+import threading
+from types import MappingProxyType
+
+LANGUAGES_FILE = './config/languages.json'
+LOCALES_DIR = './config/languages'
+LOCALE_RE = re.compile(r'^[A-Za-z0-9_-]+$')
+
+_cache = {}  # {path: ((mtime_ns, size), parsed json)}
+_cache_lock = threading.Lock()
+
+def _read_json(path):
+    """Parsed content of a JSON file, from memory unless the file changed on disk."""
+    stat = os.stat(path)
+    signature = (stat.st_mtime_ns, stat.st_size)
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == signature:
+        return cached[1]
+    with _cache_lock:
+        with open(path, 'r', encoding="utf-8") as f:
+            data = json.load(f)
+        _cache[path] = (signature, data)
+        return data
+
+def _write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=4)
+    # mtime granularity can hide quick successive writes, so drop it explicitly.
+    _cache.pop(path, None)
+
+def _per_locale():
+    return os.path.isdir(LOCALES_DIR)
+
+def _locale_path(locale):
+    return os.path.join(LOCALES_DIR, f'{locale}.json')
 
 def load_langs():
     try:
-        with open('./config/languages.json','r', encoding="utf-8") as langs:
-            lang_db = json.load(langs)
-            return lang_db
+        if _per_locale():
+            return {
+                name[:-len('.json')]: _read_json(os.path.join(LOCALES_DIR, name))
+                for name in sorted(os.listdir(LOCALES_DIR)) if name.endswith('.json')
+            }
+        # A copy, so callers can add or drop locales without touching the cache.
+        return dict(_read_json(LANGUAGES_FILE))
     except:
         print('Ocorreu um erro ao carregar a base de dados.')
 
+def load_lang(locale):
+    """A single locale's [pack], or None if it does not exist."""
+    if _per_locale():
+        if not LOCALE_RE.match(locale or ''):
+            return None
+        try:
+            return _read_json(_locale_path(locale))
+        except FileNotFoundError:
+            return None
+        except:
+            print('Ocorreu um erro ao carregar a base de dados.')
+            return None
+    try:
+        return _read_json(LANGUAGES_FILE).get(locale)
+    except:
+        print('Ocorreu um erro ao carregar a base de dados.')
+        return None
+
 def save_new_lang(lang):
-    with open('./config/languages.json', 'w') as f:
-        json.dump(lang, f, indent=4)
+    if _per_locale():
+        for locale, content in lang.items():
+            if LOCALE_RE.match(locale):
+                _write_json(_locale_path(locale), content)
+        return
+    _write_json(LANGUAGES_FILE, lang)
+
+def split_langs():
+    """Switch to the per-locale layout by writing every locale of languages.json to its own file."""
+    languages = _read_json(LANGUAGES_FILE)
+    os.makedirs(LOCALES_DIR, exist_ok=True)
+    save_new_lang(languages)
 
 def change_general_language(new_lang):
+    if _per_locale():
+        lang_content = load_lang(new_lang)
+        if lang_content is None:
+            return False
+        save_new_lang({'default': lang_content})
+        return True
     languages = load_langs()
     if new_lang in languages:
         lang_content = languages[new_lang]
@@ -30,11 +109,11 @@ def change_general_language(new_lang):
         return False
 
 def get_user_lang(user_lang):
-    langs = load_langs()
-    if user_lang in langs:
-        return langs[user_lang][0]
-    else:
-        return langs["default"][0]
+    """Read-only view of a locale's strings; the parsed pack is shared by every request."""
+    lang = load_lang(user_lang)
+    if lang is None:
+        lang = load_lang('default')
+    return MappingProxyType(lang[0])
 
 if __name__ == '__main__':
-    print("This module should not be run directly.")
\ No newline at end of file
+    print("This module should not be run directly.")
@@ -10,7 +10,8 @@ import hashlib
 import uuid
 from datetime import datetime, timedelta
 import pytz
-from database_modules.sqlite_handler import SQLiteConfig
+from database_modules.sqlite_handler import SQLiteConfig, VersionCounter
+from database_modules.records import Ban, Timeout
 
 # Default IANA timezone for new installs and fallbacks (US Eastern).
 DEFAULT_SITE_TIMEZONE = 'America/New_York'
@@ -21,18 +22,98 @@ ANONYMOUS_MODE_HYBRID = 'hybrid'
 ANONYMOUS_MODE_OPTIONS = (ANONYMOUS_MODE_SURFACE, ANONYMOUS_MODE_ANONYMOUS, ANONYMOUS_MODE_HYBRID)
 ANONYMOUS_HASH_PREFIX = 'anon::'
 
+CHAN_CONFIG_DEFAULTS = {
+    'free_board_creation': 1,
+    'index_news': "No news to display",
+    'sidebar_enabled': 0,
+    'max_pages_per_board': 0,
+    'default_poster_name': "Anonymous",
+    'posts_per_page': 6,
+    'max_upload_size_mb': 24,
+    'site_custom_css': '',
+    'site_timezone': DEFAULT_SITE_TIMEZONE,
+    'enforce_reply_before_thread': 1,
+    'anonymous_mode': ANONYMOUS_MODE_SURFACE,
+    'force_captcha_anonymous': 0
+}
+
+# Shared by every manager below. Tables are created and upgraded by MIGRATIONS.
+MODERATION_DB = SQLiteConfig.load_db('moderation')
+MODERATION_DB.define_table('timeouts', {
+    'user_ip': 'str',
+    'user_role': 'str',
+    'end_time': 'str',
+    'reason': 'str',
+    'moderator': 'str',
+    'applied_at': 'str'
+}, indexes=['user_ip'], record_class=Timeout)
+
+MODERATION_DB.define_table('bans', {
+    'user_ip': 'str',
+    'end_time': 'str',
+    'reason': 'str',
+    'moderator': 'str',
+    'applied_at': 'str',
+    'boards': 'list',
+    'is_permanent': 'bool'
+}, indexes=['user_ip'], record_class=Ban)
+
+MODERATION_DB.define_table('thread_creation_allowed_ips', {
+    'ip': 'str',
+    'expire_at': 'str'
+}, indexes=['ip'])
+
+MODERATION_DB.define_table('reports', {
+    'id': 'int',
+    'motivo': 'str',
+    'post_id': 'int',
+    'board': 'str',
+    'solved': 'int'
+}, indexes=['post_id', 'board'])
+
+MODERATION_DB.define_table('chan_config', {
+    'id': 'int',
+    'free_board_creation': 'int',
+    'index_news': 'str',
+    'sidebar_enabled': 'int',
+    'max_pages_per_board': 'int',
+    'default_poster_name': 'str',
+    'posts_per_page': 'int',
+    'max_upload_size_mb': 'int',
+    'site_custom_css': 'str',
+    'site_timezone': 'str',
+    'enforce_reply_before_thread': 'int',
+    'anonymous_mode': 'str',
+    'force_captcha_anonymous': 'int'
+})
+
+MODERATION_DB.define_table('word_filters', {
+    'word': 'str',
+    'filter': 'str'
+})
+
+# Bumped on every config change so other workers know to reload their snapshot.
+CHAN_CONFIG_SEQUENCE = 'chan_config'
+
+def _migrate_chan_config(db):
+    """Create the configuration record, or fill settings added after it was created."""
+    if not db.exists('chan_config'):
+        db.insert('chan_config', dict(CHAN_CONFIG_DEFAULTS, id=1))
+        return
+    for column, default in CHAN_CONFIG_DEFAULTS.items():
+        db.update_where('chan_config', {column: {'==': None}}, {column: default})
+
+MIGRATIONS = [
+    (1, 'create tables, columns and indexes', lambda db: db.sync_tables()),
+    (2, 'chan_config record and defaults', _migrate_chan_config),
+    (3, 'chan_config version counter', lambda db: db.create_sequence(CHAN_CONFIG_SEQUENCE)),
+]
+
+MODERATION_DB.migrate(MIGRATIONS)
+
 class TimeoutManager:
     def __init__(self):
-        # Initialize SQLite for timeout management
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('timeouts', {
-            'user_ip': 'str',
-            'user_role': 'str',
-            'end_time': 'str',
-            'reason': 'str',
-            'moderator': 'str',
-            'applied_at': 'str'
-        })
+        self.db = MODERATION_DB
         
         self.lock = threading.Lock()
         self.active_timers = {}
@@ -70,8 +151,7 @@ class TimeoutManager:
                 })
             else:
                 # Create new timeout record
-                max_timeout_id = max([timeout['id'] for timeout in self.db.find_all('timeouts')] + [0])
-                timeout_id = max_timeout_id + 1
+                timeout_id = self.db.max('timeouts', 'id', default=0) + 1
 
                 self.db.insert('timeouts', {
                     'id': timeout_id,
@@ -182,7 +262,7 @@ class TimeoutManager:
         Cleanup all expired timeouts.
         """
         now = datetime.now()
-        timeouts = self.db.find_all('timeouts')
+        timeouts = self.db.find_all('timeouts', columns=['id', 'end_time'])
         
         for timeout in timeouts:
             end_time = datetime.fromisoformat(timeout['end_time'])
@@ -192,17 +272,7 @@ class TimeoutManager:
 
 class BanManager:
     def __init__(self):
-        # Initialize SQLite for ban management
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('bans', {
-            'user_ip': 'str',
-            'end_time': 'str',
-            'reason': 'str',
-            'moderator': 'str',
-            'applied_at': 'str',
-            'boards': 'list',
-            'is_permanent': 'bool'
-        })
+        self.db = MODERATION_DB
         
         self.lock = threading.Lock()
         self.active_timers = {}
@@ -273,8 +343,7 @@ class BanManager:
                 if ban_id in self.active_timers:
                     self.active_timers[ban_id].cancel()
             else:
-                max_id = max([ban['id'] for ban in self.db.find_all('bans')] + [0])
-                ban_id = max_id + 1
+                ban_id = self.db.max('bans', 'id', default=0) + 1
                 self.db.insert('bans', {
                     'id': ban_id,
                     'user_ip': user_ip,
@@ -378,7 +447,7 @@ class BanManager:
         """
         now = datetime.now()
         
-        for ban in self.db.find_all('bans'):
+        for ban in self.db.find_all('bans', columns=['id', 'end_time', 'is_permanent']):
             if not ban['is_permanent']:
                 end_time = datetime.fromisoformat(ban['end_time'])
                 
@@ -388,15 +457,11 @@ class BanManager:
 
 class ThreadCreationAllowlistManager:
     def __init__(self):
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('thread_creation_allowed_ips', {
-            'ip': 'str',
-            'expire_at': 'str'
-        })
+        self.db = MODERATION_DB
 
     def _cleanup_expired(self):
         now = datetime.now()
-        entries = self.db.find_all('thread_creation_allowed_ips')
+        entries = self.db.find_all('thread_creation_allowed_ips', columns=['id', 'expire_at'])
         for entry in entries:
             expire_raw = entry.get('expire_at')
             try:
@@ -432,9 +497,7 @@ class ThreadCreationAllowlistManager:
             entry_id = existing[0]['id']
             self.db.update('thread_creation_allowed_ips', entry_id, {'expire_at': expire_at})
         else:
-            entries = self.db.find_all('thread_creation_allowed_ips')
-            max_id = max([e.get('id', 0) for e in entries] + [0])
-            entry_id = max_id + 1
+            entry_id = self.db.max('thread_creation_allowed_ips', 'id', default=0) + 1
             self.db.insert('thread_creation_allowed_ips', {
                 'id': entry_id,
                 'ip': ip,
@@ -444,15 +507,7 @@ class ThreadCreationAllowlistManager:
 
 class ReportManager:
     def __init__(self):
-        # Initialize SQLite for report management
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('reports', {
-            'id': 'int',
-            'motivo': 'str',
-            'post_id': 'int',
-            'board': 'str',
-            'solved': 'int'
-        })
+        self.db = MODERATION_DB
 
     def add_report(self, motivo, post_id, board, solved=False):
         """
@@ -467,8 +522,7 @@ class ReportManager:
         Returns:
             bool: True if report was added successfully
         """
-        max_id = max([r['id'] for r in self.db.find_all('reports')] + [0])
-        report_id = max_id + 1
+        report_id = self.db.max('reports', 'id', default=0) + 1
         
         self.db.insert('reports', {
             'id': report_id,
@@ -692,77 +746,36 @@ def should_force_captcha_for_identifier(user_identifier):
 
 
 class ChanConfigManager:
+    # Process-wide snapshot: (version, config record).
+    _snapshot = None
+    _snapshot_lock = threading.Lock()
+    _version = VersionCounter(MODERATION_DB, CHAN_CONFIG_SEQUENCE)
+
     def __init__(self):
-        # Initialize SQLite for chan config
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('chan_config', {
-            'id': 'int',
-            'free_board_creation': 'int',
-            'index_news': 'str',
-            'sidebar_enabled': 'int',
-            'max_pages_per_board': 'int',
-            'default_poster_name': 'str',
-            'posts_per_page': 'int',
-            'max_upload_size_mb': 'int',
-            'site_custom_css': 'str',
-            'site_timezone': 'str',
-            'enforce_reply_before_thread': 'int',
-            'anonymous_mode': 'str',
-            'force_captcha_anonymous': 'int'
-        })
-        self._ensure_record()
-
-    def _ensure_record(self):
-        """Ensure that the configuration record exists."""
-        configs = self.db.find_all('chan_config')
-        if not configs:
-            self.db.insert('chan_config', {
-                'id': 1,
-                'free_board_creation': 1,
-                'index_news': "No news to display",
-                'sidebar_enabled': 0,
-                'max_pages_per_board': 0,
-                'default_poster_name': "Anonymous",
-                'posts_per_page': 6,
-                'max_upload_size_mb': 24,
-                'site_custom_css': '',
-                'site_timezone': DEFAULT_SITE_TIMEZONE,
-                'enforce_reply_before_thread': 1,
-                'anonymous_mode': ANONYMOUS_MODE_SURFACE,
-                'force_captcha_anonymous': 0
-            })
-        else:
-            config = configs[0]
-            if 'sidebar_enabled' not in config:
-                self.db.update('chan_config', config['id'], {'sidebar_enabled': 0})
-            if 'max_pages_per_board' not in config:
-                self.db.update('chan_config', config['id'], {'max_pages_per_board': 0})
-            if 'default_poster_name' not in config:
-                self.db.update('chan_config', config['id'], {'default_poster_name': "Anonymous"})
-            if 'posts_per_page' not in config:
-                self.db.update('chan_config', config['id'], {'posts_per_page': 6})
-            if 'max_upload_size_mb' not in config:
-                self.db.update('chan_config', config['id'], {'max_upload_size_mb': 24})
-            if 'site_custom_css' not in config:
-                self.db.update('chan_config', config['id'], {'site_custom_css': ''})
-            if 'site_timezone' not in config:
-                self.db.update('chan_config', config['id'], {'site_timezone': DEFAULT_SITE_TIMEZONE})
-            if 'enforce_reply_before_thread' not in config:
-                self.db.update('chan_config', config['id'], {'enforce_reply_before_thread': 1})
-            if 'anonymous_mode' not in config:
-                self.db.update('chan_config', config['id'], {'anonymous_mode': ANONYMOUS_MODE_SURFACE})
-            if 'force_captcha_anonymous' not in config:
-                self.db.update('chan_config', config['id'], {'force_captcha_anonymous': 0})
+        self.db = MODERATION_DB
+
+    def _load_snapshot(self):
+        with ChanConfigManager._snapshot_lock:
+            version = self._version.current()
+            config = self.db.find_all('chan_config', limit=1)[0]
+            ChanConfigManager._snapshot = (version, config)
+            return ChanConfigManager._snapshot
 
     def get_config(self):
         """
         Get the chan configuration.
+
+        Served from an in-memory snapshot that is only re-read when the config
+        version moved (also when another worker changed it).
         
         Returns:
             dict: The configuration record
         """
-        self._ensure_record()
-        return self.db.find_all('chan_config')[0]
+        snapshot = ChanConfigManager._snapshot
+        if snapshot is None or snapshot[0] != self._version.current():
+            snapshot = self._load_snapshot()
+        # A copy, so callers cannot change the shared snapshot.
+        return dict(snapshot[1])
 
     @staticmethod
     def get_tz_offset_iso_for_config(chan_config):
@@ -809,7 +822,6 @@ class ChanConfigManager:
             index_news (str): News to display on index
             sidebar_enabled (bool): Whether to enable sidebar layout on /
         """
-        self._ensure_record()
         config = self.get_config()
         updates = {}
         
@@ -874,17 +886,16 @@ class ChanConfigManager:
             updates['force_captcha_anonymous'] = 1 if force_captcha_anonymous else 0
             
         if updates:
-            self.db.update('chan_config', config['id'], updates)
+            with self.db.transaction():
+                self.db.update('chan_config', config['id'], updates)
+                self._version.bump()
+            # Write-through: this worker sees the change immediately.
+            self._load_snapshot()
 
 
 class WordFilterManager:
     def __init__(self):
-        # Initialize SQLite for word filters
-        self.db = SQLiteConfig.load_db('moderation')
-        self.db.create_table('word_filters', {
-            'word': 'str',
-            'filter': 'str'
-        })
+        self.db = MODERATION_DB
 
     def get_filters(self):
         return self.db.find_all('word_filters')
@@ -892,8 +903,7 @@ class WordFilterManager:
     def add_filter(self, word, replacement, mode='word'):
         if not word:
             return False
-        existing = self.get_filters()
-        new_id = max([f.get('id', 0) for f in existing] + [0]) + 1
+        new_id = self.db.max('word_filters', 'id', default=0) + 1
         stored_word = word + '*' if mode == 'prefix' else word
         self.db.insert('word_filters', {
             'id': new_id,
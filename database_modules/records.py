@@ -0,0 +1,229 @@
+"""
+Compact row records for the busiest tables.
+Each record keeps its columns in __slots__ instead of a per-row dict, while
+still behaving like a mapping (record['x'], .get, in, items, dict(record)),
+so existing code and Jinja templates keep working unchanged.
+"""
+
+import copy
+from abc import ABCMeta
+from collections.abc import MutableMapping
+
+from database_modules.sqlite_handler import json_loads
+
+class RecordMeta(ABCMeta):
+    """Turns FIELDS / JSON_FIELDS into __slots__ plus lazy-decoding properties."""
+
+    def __new__(mcs, name, bases, namespace):
+        fields = tuple(namespace.get('FIELDS', ()))
+        json_fields = tuple(namespace.get('JSON_FIELDS', ()))
+        slot_names = {}
+        json_bits = {}
+        slots = []
+        for field in fields:
+            slot = f"_raw_{field}" if field in json_fields else field
+            slot_names[field] = slot
+            slots.append(slot)
+            if field in json_fields:
+                # Still-encoded JSON columns are tracked as bits of an int.
+                json_bits[field] = 1 << len(json_bits)
+                namespace[field] = _json_property(slot, json_bits[field])
+        namespace.setdefault('__slots__', tuple(slots))
+        if fields:
+            namespace['_SLOT_NAMES'] = slot_names
+            namespace['_JSON_BITS'] = json_bits
+            namespace['_ROW_PLANS'] = {}
+        cls = super().__new__(mcs, name, bases, namespace)
+        if fields:
+            # Raw slot descriptors, bypassing the JSON properties when loading rows.
+            cls._SLOT_SETTERS = {field: cls.__dict__[slot].__set__ for field, slot in slot_names.items()}
+        return cls
+
+def _json_property(slot, bit):
+    def getter(self):
+        value = object.__getattribute__(self, slot)
+        if self._pending & bit:
+            self._pending &= ~bit
+            try:
+                value = json_loads(value)
+            except (ValueError, TypeError):
+                return value  # Keep as is if decode fails
+            object.__setattr__(self, slot, value)
+        return value
+
+    def setter(self, value):
+        self._pending &= ~bit
+        object.__setattr__(self, slot, value)
+
+    def deleter(self):
+        object.__delattr__(self, slot)
+
+    return property(getter, setter, deleter)
+
+class Record(MutableMapping, metaclass=RecordMeta):
+    """
+    Base for slot-backed rows. Columns not listed in FIELDS (older schemas,
+    values attached by callers) go to a small overflow dict.
+    """
+    __slots__ = ('_extra', '_pending')
+    FIELDS = ()
+    JSON_FIELDS = ()
+    _SLOT_NAMES = {}
+    _JSON_BITS = {}
+    _SLOT_SETTERS = {}
+    _ROW_PLANS = {}
+
+    def __init__(self, data=None, **kwargs):
+        self._extra = None
+        self._pending = 0
+        if data is not None:
+            self.update(data)
+        if kwargs:
+            self.update(kwargs)
+
+    @classmethod
+    def _row_plan(cls, keys):
+        """(key, slot setter or None, json bit) per column, cached per column list."""
+        keys = tuple(keys)
+        plan = cls._ROW_PLANS.get(keys)
+        if plan is None:
+            plan = tuple((key, cls._SLOT_SETTERS.get(key), cls._JSON_BITS.get(key, 0)) for key in keys)
+            cls._ROW_PLANS[keys] = plan
+        return plan
+
+    @classmethod
+    def from_row(cls, keys, values):
+        """Build a record from column names and a row; JSON columns stay encoded until read."""
+        record = cls.__new__(cls)
+        extra = None
+        pending = 0
+        for (key, setter, bit), value in zip(cls._row_plan(keys), values):
+            if setter is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+                continue
+            setter(record, value)
+            if bit and value.__class__ is str:
+                pending |= bit
+        record._extra = extra
+        record._pending = pending
+        return record
+
+    def _has_field(self, field):
+        try:
+            object.__getattribute__(self, self._SLOT_NAMES[field])
+        except AttributeError:
+            return False
+        return True
+
+    def __getitem__(self, key):
+        if key in self._SLOT_NAMES:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key) from None
+        if self._extra is not None and key in self._extra:
+            return self._extra[key]
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key in self._SLOT_NAMES:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self._SLOT_NAMES:
+            if not self._has_field(key):
+                raise KeyError(key)
+            delattr(self, key)
+        elif self._extra is not None and key in self._extra:
+            del self._extra[key]
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self._SLOT_NAMES:
+            return self._has_field(key)
+        return self._extra is not None and key in self._extra
+
+    def __iter__(self):
+        for field in self.FIELDS:
+            if self._has_field(field):
+                yield field
+        if self._extra is not None:
+            yield from list(self._extra)
+
+    def __len__(self):
+        count = len(self._extra) if self._extra is not None else 0
+        for field in self.FIELDS:
+            if self._has_field(field):
+                count += 1
+        return count
+
+    def __bool__(self):
+        if self._extra:
+            return True
+        return any(self._has_field(field) for field in self.FIELDS)
+
+    def copy(self):
+        return dict(self)
+
+    def to_dict(self):
+        """Plain dict with JSON columns decoded and copied, e.g. for a JSON response."""
+        data = dict(self)
+        for field in self.JSON_FIELDS:
+            if field in data:
+                data[field] = copy.deepcopy(data[field])
+        return data
+
+    def __copy__(self):
+        """
+        Same-class copy. Still-encoded JSON columns stay encoded and already
+        decoded ones are deep-copied, so the clone never shares their lists.
+        """
+        cls = type(self)
+        clone = cls.__new__(cls)
+        for field, slot in cls._SLOT_NAMES.items():
+            try:
+                value = object.__getattribute__(self, slot)
+            except AttributeError:
+                continue
+            bit = cls._JSON_BITS.get(field, 0)
+            if bit and not self._pending & bit:
+                value = copy.deepcopy(value)
+            object.__setattr__(clone, slot, value)
+        clone._extra = dict(self._extra) if self._extra is not None else None
+        clone._pending = self._pending
+        return clone
+
+    def __repr__(self):
+        return f"{type(self).__name__}({dict(self)!r})"
+
+class Post(Record):
+    FIELDS = ('id', 'user_ip', 'post_id', 'post_user', 'post_subject', 'post_date', 'board',
+              'original_content', 'post_content', 'post_images', 'locked', 'visible', 'media_approved',
+              'bumped_at', 'reply_count', 'image_count', 'last_reply_id', 'last_reply_at')
+    JSON_FIELDS = ('post_images',)
+
+class Reply(Record):
+    FIELDS = ('id', 'user_ip', 'reply_id', 'post_id', 'post_user', 'post_subject', 'post_date',
+              'content', 'images', 'media_approved', 'replied_at')
+    JSON_FIELDS = ('images', 'replied_at')
+
+class Board(Record):
+    FIELDS = ('id', 'board_uri', 'board_name', 'board_desc', 'board_owner', 'board_staffs',
+              'enable_captcha', 'board_isvisible', 'board_islocked', 'tag', 'require_media_approval',
+              'allow_name', 'allow_thread_self_mod', 'show_thread_poster_id', 'max_pages',
+              'max_upload_size_mb', 'default_css', 'custom_css', 'default_poster_name', 'board_lang')
+    JSON_FIELDS = ('board_staffs',)
+
+class Ban(Record):
+    FIELDS = ('id', 'user_ip', 'end_time', 'reason', 'moderator', 'applied_at', 'boards', 'is_permanent')
+    JSON_FIELDS = ('boards',)
+
+class Timeout(Record):
+    FIELDS = ('id', 'user_ip', 'user_role', 'end_time', 'reason', 'moderator', 'applied_at')
@@ -1,12 +1,460 @@
 import sqlite3
+import copy
+import functools
 import json
 import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
+from datetime import datetime
 from typing import Dict, List, Optional, Any, Union
 
-class SQLiteHandler:
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+IDENTIFIER_RE = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+JSON_COLUMN_TYPES = ('list', 'dict')
+
+if orjson is not None:
+    def json_dumps(value):
+        try:
+            return orjson.dumps(value).decode('utf-8')
+        except TypeError:
+            # e.g. non-string dict keys, which orjson refuses by default
+            return json.dumps(value)
+
+    json_loads = orjson.loads
+else:
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+class LazyRecord(dict):
+    """
+    A row dict whose JSON columns are decoded on first access.
+    Anything that needs every value (items(), values(), copies, comparisons,
+    json encoding) decodes the remaining columns first.
+    """
+    __slots__ = ('_pending',)
+
+    def __init__(self, row, pending):
+        dict.__init__(self, row)
+        self._pending = pending
+
+    def _decode(self, key):
+        self._pending.discard(key)
+        value = dict.__getitem__(self, key)
+        try:
+            value = json_loads(value)
+        except (ValueError, TypeError):
+            return value  # Keep as is if decode fails
+        dict.__setitem__(self, key, value)
+        return value
+
+    def _decode_all(self):
+        for key in list(self._pending):
+            self._decode(key)
+
+    def __getitem__(self, key):
+        if key in self._pending:
+            return self._decode(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._pending:
+            return self._decode(key)
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        self._pending.discard(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._pending.discard(key)
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        # Overriding __iter__ makes dict(record) / {**record} go through __getitem__.
+        return dict.__iter__(self)
+
+    def pop(self, key, *default):
+        if key in self._pending:
+            self._decode(key)
+        return dict.pop(self, key, *default)
+
+    def popitem(self):
+        self._decode_all()
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        if key in self._pending:
+            return self._decode(key)
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        other = dict(*args, **kwargs)
+        self._pending.difference_update(other)
+        dict.update(self, other)
+
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+
+    def copy(self):
+        self._decode_all()
+        return dict(self)
+
+    def to_dict(self):
+        """Plain dict with JSON columns decoded and copied, e.g. for a JSON response."""
+        return copy.deepcopy(self.copy())
+
+    def __eq__(self, other):
+        self._decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other):
+        self._decode_all()
+        return dict.__ne__(self, other)
+
+    def __repr__(self):
+        self._decode_all()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        # Copies and pickles come back as plain, fully decoded dicts.
+        self._decode_all()
+        return (dict, (dict(self),))
+
+def _plain_rows(rows):
+    return [dict(row) for row in rows]
+
+def compile_codecs(columns: Dict[str, str], record_class=None):
+    """
+    Build the (serializer, deserializer, rows deserializer) of a table once, so
+    per-row work only touches its JSON columns instead of looking up every
+    column type. With a record_class (see records.py) rows become slot records.
+    """
+    json_columns = frozenset(col for col, col_type in columns.items() if col_type in JSON_COLUMN_TYPES)
+
+    if json_columns:
+        def serialize(record):
+            """Convert list/dict to JSON strings for storage"""
+            out = dict(record)
+            for k in json_columns.intersection(out):
+                if out[k] is not None:
+                    out[k] = json_dumps(out[k])
+            return out
+    else:
+        serialize = dict
+
+    if record_class is not None:
+        def deserialize(row):
+            return record_class.from_row(row.keys(), row)
+
+        def deserialize_rows(rows):
+            if not rows:
+                return []
+            keys = rows[0].keys()
+            from_row = record_class.from_row
+            return [from_row(keys, row) for row in rows]
+    elif json_columns:
+        def deserialize(row):
+            out = dict(row)
+            pending = {k for k in json_columns.intersection(out) if isinstance(out[k], str)}
+            return LazyRecord(out, pending) if pending else out
+
+        def deserialize_rows(rows):
+            return [deserialize(row) for row in rows]
+    else:
+        deserialize, deserialize_rows = dict, _plain_rows
+
+    return serialize, deserialize, deserialize_rows
+
+PLAIN_CODECS = (dict, dict, _plain_rows)
+
+class ConnectionPool:
+    """
+    Bounded pool of configured connections per database file, shared by every
+    thread of the process. A connection is checked out for one statement group
+    and returned right after, so request threads (one per request under the
+    threading server) reuse the process' connections instead of opening their
+    own. A transaction() keeps its connection until it ends.
+    """
+    BUSY_TIMEOUT_MS = 5000
+    PRAGMAS = (
+        "PRAGMA journal_mode=WAL",
+        "PRAGMA synchronous=NORMAL",
+        f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}",
+        "PRAGMA mmap_size=268435456",  # 256 MB
+        "PRAGMA cache_size=-16000",  # ~16 MB
+        "PRAGMA temp_store=MEMORY"
+    )
+    # Connections per database file and process (RCHAN_DB_POOL_SIZE).
+    MAX_CONNECTIONS = int(os.environ.get('RCHAN_DB_POOL_SIZE', '16'))
+    CHECKOUT_TIMEOUT = 30  # seconds to wait for a free connection
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pid = None
+        self._idle = {}  # {db_path: LifoQueue of idle connections}, most recently used first
+        self._opened = {}  # {db_path: connections opened by this process}
+        self._local = threading.local()  # {db_path: open transaction} of each thread
+
+    def _check_fork(self):
+        """Called with the lock held. Connections must not cross a fork (e.g. gunicorn preloading the app)."""
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._idle = {}
+            self._opened = {}
+            self._local = threading.local()
+
+    def open(self, db_path):
+        """A new configured connection, outside the pool."""
+        conn = sqlite3.connect(db_path, timeout=self.BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for pragma in self.PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _checkout(self, db_path):
+        with self._lock:
+            self._check_fork()
+            idle = self._idle.setdefault(db_path, queue.LifoQueue())
+            try:
+                return idle.get_nowait()
+            except queue.Empty:
+                pass
+            can_open = self._opened.get(db_path, 0) < self.MAX_CONNECTIONS
+            if can_open:
+                self._opened[db_path] = self._opened.get(db_path, 0) + 1
+        if can_open:
+            try:
+                return self.open(db_path)
+            except Exception:
+                with self._lock:
+                    self._opened[db_path] -= 1
+                raise
+        try:
+            return idle.get(timeout=self.CHECKOUT_TIMEOUT)
+        except queue.Empty:
+            raise sqlite3.OperationalError(f"No free connection to {db_path}")
+
+    def _checkin(self, db_path, conn):
+        if conn.in_transaction:
+            conn.rollback()  # Never hand an open transaction to the next user.
+        with self._lock:
+            self._idle.setdefault(db_path, queue.LifoQueue()).put(conn)
+
+    def _transactions(self):
+        with self._lock:
+            self._check_fork()
+            local = self._local
+        transactions = getattr(local, 'transactions', None)
+        if transactions is None:
+            transactions = local.transactions = {}
+        return transactions
+
+    @contextmanager
+    def connection(self, db_path):
+        """A connection for one statement group: the open transaction's, if this thread has one."""
+        transaction = self._transactions().get(db_path)
+        if transaction is not None:
+            yield transaction['conn']
+            return
+        conn = self._checkout(db_path)
+        try:
+            yield conn
+        finally:
+            self._checkin(db_path, conn)
+
+    def in_transaction(self, db_path):
+        return db_path in self._transactions()
+
+    def enter_transaction(self, db_path, conn=None):
+        """
+        Increase the unit-of-work depth, checking out the connection the whole
+        transaction will use (or using conn, e.g. the WriteQueue's own).
+        Returns (transaction, True for the outermost level).
+        """
+        transactions = self._transactions()
+        transaction = transactions.get(db_path)
+        if transaction is not None:
+            transaction['depth'] += 1
+            return transaction, False
+        transaction = {'conn': conn or self._checkout(db_path), 'pooled': conn is None, 'depth': 1,
+                       'callbacks': []}
+        transactions[db_path] = transaction
+        return transaction, True
+
+    def leave_transaction(self, db_path):
+        transactions = self._transactions()
+        transaction = transactions[db_path]
+        transaction['depth'] -= 1
+        if transaction['depth'] == 0:
+            del transactions[db_path]
+            if transaction['pooled']:
+                self._checkin(db_path, transaction['conn'])
+
+    def commit_callbacks(self, db_path):
+        """Callbacks waiting for the open transaction on db_path to commit."""
+        return self._transactions()[db_path]['callbacks']
+
+    def close(self):
+        """Close every idle connection of this process (checked out ones stay open)."""
+        with self._lock:
+            self._check_fork()
+            for db_path, idle in self._idle.items():
+                while True:
+                    try:
+                        conn = idle.get_nowait()
+                    except queue.Empty:
+                        break
+                    self._opened[db_path] -= 1
+                    try:
+                        conn.close()
+                    except sqlite3.Error:
+                        pass
+
+
+POOL = ConnectionPool()
+
+BEGIN_RETRIES = 5
+
+def _is_busy(error):
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    message = str(error).lower()
+    return 'locked' in message or 'busy' in message
+
+def begin_immediate(conn):
+    """
+    BEGIN IMMEDIATE, retried with a growing pause while another process keeps
+    the write lock beyond busy_timeout, instead of failing on the first SQLITE_BUSY.
+    """
+    for attempt in range(BEGIN_RETRIES):
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            return
+        except sqlite3.OperationalError as e:
+            if attempt == BEGIN_RETRIES - 1 or not _is_busy(e):
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+class WriteQueue:
+    """
+    Single writer for one database file: a daemon thread owns every queued
+    write and drains the queue into batched transactions. Each operation runs
+    under its own savepoint, so one failing write does not undo the others;
+    callers get their result (or exception) back through a Future.
+
+    An operation may be a whole unit of work (see SQLiteHandler.run_in_transaction):
+    while it runs, the writer's connection is this thread's open transaction,
+    so every handler call it makes joins the savepoint, and its on_commit()
+    callbacks run once the batch has committed.
+    """
+    MAX_BATCH = 64
+
     def __init__(self, db_path):
         self.db_path = db_path
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name=f"sqlite-writer:{db_path}", daemon=True)
+        self._thread.start()
+
+    def is_writer_thread(self):
+        return threading.current_thread() is self._thread
+
+    def submit(self, operation):
+        """Queue operation(conn) for the writer thread and return its Future."""
+        future = Future()
+        self._queue.put((operation, future))
+        return future
+
+    def _run(self):
+        conn = POOL.open(self.db_path)  # The writer's own, outside the pool.
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.MAX_BATCH:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            self._execute(conn, batch)
+
+    def _execute(self, conn, batch):
+        outcomes = []
+        try:
+            begin_immediate(conn)
+            for operation, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT queued_write")
+                transaction, _ = POOL.enter_transaction(self.db_path, conn)
+                try:
+                    outcomes.append((future, operation(conn), None, transaction['callbacks']))
+                except Exception as e:
+                    conn.execute("ROLLBACK TO queued_write")
+                    outcomes.append((future, None, e, ()))
+                finally:
+                    POOL.leave_transaction(self.db_path)
+                conn.execute("RELEASE queued_write")
+            conn.commit()
+        except Exception as e:
+            # The batch as a whole failed (e.g. the lock could not be taken).
+            try:
+                conn.rollback()
+            except sqlite3.Error:
+                pass
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for future, result, error, callbacks in outcomes:
+            try:
+                for callback in callbacks:
+                    callback()
+            except Exception as e:
+                error = e
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+_WRITE_QUEUES = {}
+_WRITE_QUEUES_LOCK = threading.Lock()
+
+def get_write_queue(db_path):
+    """Return this process' writer for db_path, starting it on first use."""
+    key = (os.getpid(), db_path)
+    with _WRITE_QUEUES_LOCK:
+        writer = _WRITE_QUEUES.get(key)
+        if writer is None:
+            writer = WriteQueue(db_path)
+            _WRITE_QUEUES[key] = writer
+        return writer
+
+class SQLiteHandler:
+    BATCH_SIZE = 500  # Stays below SQLite's bound parameter limit.
+    # Route writes through one WriteQueue thread per database (RCHAN_SINGLE_WRITER=1).
+    SINGLE_WRITER = os.environ.get('RCHAN_SINGLE_WRITER', '0').lower() in ('1', 'true', 'yes')
+
+    def __init__(self, db_path, single_writer=None):
+        self.db_path = db_path
+        self.single_writer = self.SINGLE_WRITER if single_writer is None else single_writer
         self.column_types = {}  # {table_name: {col_name: type_str}}
+        self.codecs = {}  # {table_name: (serializer, deserializer, rows deserializer)}
+        self.tables = {}  # {table_name: definition} for sync_table()
         self._ensure_db_dir()
 
     def _ensure_db_dir(self):
@@ -14,14 +462,122 @@ class SQLiteHandler:
         if directory and not os.path.exists(directory):
             os.makedirs(directory)
 
+    @contextmanager
     def _get_connection(self):
-        conn = sqlite3.connect(self.db_path)
-        conn.row_factory = sqlite3.Row
-        return conn
+        """
+        Pooled connection for one statement group. Commits (or rolls back) on
+        exit, unless a transaction() is open on this thread, which then owns it.
+        """
+        with POOL.connection(self.db_path) as conn:
+            if POOL.in_transaction(self.db_path):
+                yield conn
+            else:
+                with conn:
+                    yield conn
 
-    def create_table(self, table_name, columns: Dict[str, str]):
+    def _write(self, operation):
+        """
+        Run operation(conn) as a write. With single_writer it is handed to the
+        database's WriteQueue and this call waits for the result; inside an
+        explicit transaction() it runs directly on the caller's connection.
+        """
+        if self.single_writer and not POOL.in_transaction(self.db_path):
+            writer = get_write_queue(self.db_path)
+            if not writer.is_writer_thread():
+                return writer.submit(operation).result()
+        with self._get_connection() as conn:
+            return operation(conn)
+
+    @contextmanager
+    def transaction(self):
+        """
+        Unit of work: every handler call inside the block (on this database and
+        thread) is committed once at the end, or rolled back together on error.
+        Nested blocks join the outermost one. Writes made here bypass the
+        WriteQueue and hold the write lock themselves; run_in_transaction()
+        (or @atomic) sends a whole unit through it instead. Callbacks
+        registered with on_commit() run after the outermost block commits.
+        """
+        transaction, outermost = POOL.enter_transaction(self.db_path)
+        conn = transaction['conn']
+        committed = False
+        try:
+            if outermost:
+                begin_immediate(conn)
+            yield self
+        except BaseException:
+            if outermost:
+                conn.rollback()
+            raise
+        else:
+            if outermost:
+                conn.commit()
+                committed = True
+        finally:
+            POOL.leave_transaction(self.db_path)
+        if committed:
+            for callback in transaction['callbacks']:
+                callback()
+
+    def run_in_transaction(self, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs) as one unit of work and return its result. With
+        single_writer the whole unit is handed to the database's WriteQueue, so
+        request threads never take the write lock themselves; otherwise, or
+        inside an open transaction(), it runs in a transaction() on this thread.
+        """
+        if self.single_writer and not POOL.in_transaction(self.db_path):
+            writer = get_write_queue(self.db_path)
+            if not writer.is_writer_thread():
+                return writer.submit(lambda conn: fn(*args, **kwargs)).result()
+        with self.transaction():
+            return fn(*args, **kwargs)
+
+    def atomic(self, fn):
+        """Decorator: every call of fn is one run_in_transaction() unit of work."""
+        @functools.wraps(fn)
+        def unit_of_work(*args, **kwargs):
+            return self.run_in_transaction(fn, *args, **kwargs)
+        return unit_of_work
+
+    def on_commit(self, callback):
+        """
+        Run callback() once the open transaction() commits, or right away when
+        there is none. Callbacks of a rolled back transaction are dropped.
+        """
+        if POOL.in_transaction(self.db_path):
+            POOL.commit_callbacks(self.db_path).append(callback)
+        else:
+            callback()
+
+    def define_table(self, table_name, columns: Dict[str, str], indexes: Optional[List] = None,
+                     unique: Optional[List] = None, record_class=None):
+        """
+        Register a table's columns, codecs and indexes without touching the
+        database; sync_table() (usually from a migration) applies them.
+
+        indexes/unique are lists of column names or tuples of column names,
+        e.g. ['board', ('post_id', 'reply_id')].
+        record_class (a records.Record subclass) is returned instead of dicts.
+        """
         self.column_types[table_name] = columns
-        
+        self.codecs[table_name] = compile_codecs(columns, record_class)
+        self.tables[table_name] = {'columns': columns, 'indexes': indexes or [], 'unique': unique or []}
+
+    def create_table(self, table_name, columns: Dict[str, str], indexes: Optional[List] = None,
+                     unique: Optional[List] = None, record_class=None):
+        """Define a table and create it (if missing) with its secondary indexes."""
+        self.define_table(table_name, columns, indexes, unique, record_class)
+        self.sync_table(table_name)
+
+    def sync_table(self, table_name):
+        """
+        Bring a defined table up to date: create it, add columns missing from
+        tables made by older versions, and create its indexes. Idempotent.
+        """
+        definition = self.tables[table_name]
+        columns = definition['columns']
+
         cols_def = []
         has_id = False
         
@@ -47,47 +603,151 @@ class SQLiteHandler:
         
         with self._get_connection() as conn:
             conn.execute(query)
+            # Tables created by older versions may miss newer columns.
+            existing = {row['name'] for row in conn.execute(f"PRAGMA table_info({table_name})")}
+            for col_def in cols_def:
+                col = col_def.split(' ', 1)[0]
+                if col not in existing:
+                    conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {col_def}")
+
+        for index_cols in definition['indexes']:
+            self.create_index(table_name, index_cols)
+        for index_cols in definition['unique']:
+            self.create_index(table_name, index_cols, unique=True)
+
+    def sync_tables(self):
+        for table_name in list(self.tables):
+            self.sync_table(table_name)
+
+    def execute(self, query, params=()):
+        """Run a raw write statement (schema migrations, bulk backfills); returns rows changed."""
+        return self._write(lambda conn: conn.execute(query, params).rowcount)
+
+    @contextmanager
+    def connection(self):
+        """One pooled connection for several related reads (see VersionCounter)."""
+        with self._get_connection() as conn:
+            yield conn
+
+    @staticmethod
+    def data_version(conn):
+        """
+        PRAGMA data_version: changes whenever another connection (worker
+        process, pooled connection or the WriteQueue) has committed to the
+        database, but not on conn's own commits. Only comparable on one connection.
+        """
+        return conn.execute("PRAGMA data_version").fetchone()[0]
+
+    SCHEMA_VERSION_TABLE = 'schema_version'
+
+    def schema_version(self):
+        return self.max(self.SCHEMA_VERSION_TABLE, 'version', default=0)
+
+    def migrate(self, migrations):
+        """
+        Apply numbered migrations that this database has not seen yet.
+
+        migrations is a list of (version, description, fn) sorted by version;
+        fn(handler) runs in its own transaction together with the row that
+        records it in schema_version, so every step runs exactly once even
+        when several workers start at the same time.
+        """
+        self.create_table(self.SCHEMA_VERSION_TABLE, {
+            'id': 'int',
+            'version': 'int',
+            'description': 'str',
+            'applied_at': 'str'
+        }, unique=['version'])
+        for version, description, migration in migrations:
+            if version <= self.schema_version():
+                continue
+            if self.run_in_transaction(self._apply_migration, version, description, migration):
+                print(f"Applied {os.path.basename(self.db_path)} migration {version}: {description}")
+
+    def _apply_migration(self, version, description, migration):
+        # Re-checked under the write lock: another worker may have won the race.
+        if version <= self.schema_version():
+            return False
+        migration(self)
+        self.insert(self.SCHEMA_VERSION_TABLE, {
+            'version': version,
+            'description': description,
+            'applied_at': datetime.now().isoformat()
+        })
+        return True
+
+    def create_index(self, table_name, index_cols: Union[str, tuple, list], unique=False):
+        if isinstance(index_cols, str):
+            index_cols = (index_cols,)
+        prefix = 'uq' if unique else 'idx'
+        index_name = f"{prefix}_{table_name}_{'_'.join(index_cols)}"
+        unique_sql = "UNIQUE " if unique else ""
+        query = (f"CREATE {unique_sql}INDEX IF NOT EXISTS {index_name} "
+                 f"ON {table_name} ({', '.join(index_cols)})")
+        try:
+            with self._get_connection() as conn:
+                conn.execute(query)
+        except sqlite3.IntegrityError:
+            # Existing duplicate rows; keep the lookup fast without the constraint.
+            print(f"Duplicate values in {table_name}({', '.join(index_cols)}), creating a non-unique index.")
+            self.create_index(table_name, index_cols, unique=False)
 
     def _serialize(self, table_name, record: Dict):
         """Convert list/dict to JSON strings for storage"""
-        out = record.copy()
-        columns = self.column_types.get(table_name, {})
-        for k, v in record.items():
-            col_type = columns.get(k)
-            if col_type in ['list', 'dict'] and v is not None:
-                out[k] = json.dumps(v)
-        return out
+        return self.codecs.get(table_name, PLAIN_CODECS)[0](record)
 
     def _deserialize(self, table_name, row: sqlite3.Row):
-        """Convert JSON strings back to list/dict"""
-        out = dict(row)
-        columns = self.column_types.get(table_name, {})
-        for k, v in out.items():
-            col_type = columns.get(k)
-            if col_type in ['list', 'dict'] and isinstance(v, str):
-                try:
-                    out[k] = json.loads(v)
-                except (json.JSONDecodeError, TypeError):
-                    pass # Keep as is if decode fails
-        return out
+        """Convert a row to a dict; JSON columns are decoded lazily on access"""
+        return self.codecs.get(table_name, PLAIN_CODECS)[1](row)
+
+    def _deserialize_rows(self, table_name, rows):
+        return self.codecs.get(table_name, PLAIN_CODECS)[2](rows)
+
+    INSERT_VERBS = {'replace': 'INSERT OR REPLACE', 'ignore': 'INSERT OR IGNORE', 'abort': 'INSERT'}
+
+    def _insert_verb(self, on_conflict):
+        verb = self.INSERT_VERBS.get(on_conflict)
+        if verb is None:
+            raise ValueError(f"Unsupported on_conflict '{on_conflict}'")
+        return verb
 
-    def insert(self, table_name, record: Dict):
+    def insert(self, table_name, record: Dict, on_conflict='replace'):
+        """
+        Insert a record. on_conflict decides what a duplicate key does:
+        'replace' overwrites the existing row, 'ignore' keeps it, and 'abort'
+        raises sqlite3.IntegrityError.
+        """
+        verb = self._insert_verb(on_conflict)
         record = self._serialize(table_name, record)
         keys = list(record.keys())
         placeholders = ",".join(["?"] * len(keys))
         columns = ",".join(keys)
         values = [record[k] for k in keys]
         
-        query = f"INSERT OR REPLACE INTO {table_name} ({columns}) VALUES ({placeholders})"
+        query = f"{verb} INTO {table_name} ({columns}) VALUES ({placeholders})"
         
-        with self._get_connection() as conn:
-            conn.execute(query, values)
+        self._write(lambda conn: conn.execute(query, values).rowcount)
 
-    def find_all(self, table_name):
-        with self._get_connection() as conn:
-            cursor = conn.execute(f"SELECT * FROM {table_name}")
-            rows = cursor.fetchall()
-            return [self._deserialize(table_name, row) for row in rows]
+    def insert_many(self, table_name, records: List[Dict], on_conflict='replace'):
+        """Insert several records with executemany; records sharing the same keys are grouped."""
+        verb = self._insert_verb(on_conflict)
+        groups = {}
+        for record in records:
+            record = self._serialize(table_name, record)
+            keys = tuple(record.keys())
+            groups.setdefault(keys, []).append([record[k] for k in keys])
+
+        def insert_groups(conn):
+            for keys, rows in groups.items():
+                placeholders = ",".join(["?"] * len(keys))
+                query = f"{verb} INTO {table_name} ({','.join(keys)}) VALUES ({placeholders})"
+                conn.executemany(query, rows)
+
+        self._write(insert_groups)
+
+    def find_all(self, table_name, sort_by=None, sort_desc=False, limit=None, offset=None, columns=None):
+        return self.query(table_name, {}, sort_by=sort_by, sort_desc=sort_desc, limit=limit, offset=offset,
+                          columns=columns)
 
     def find_by_id(self, table_name, record_id):
         with self._get_connection() as conn:
@@ -108,36 +768,333 @@ class SQLiteHandler:
         values.append(record_id)
         query = f"UPDATE {table_name} SET {', '.join(set_parts)} WHERE id = ?"
         
-        with self._get_connection() as conn:
-            cursor = conn.execute(query, values)
-            return cursor.rowcount > 0
+        return self._write(lambda conn: conn.execute(query, values).rowcount) > 0
+
+    def update_many(self, table_name, records: List[Dict]):
+        """Update several records by their 'id' with executemany; returns rows changed."""
+        groups = {}
+        for record in records:
+            record = self._serialize(table_name, record)
+            record_id = record.pop('id')
+            keys = tuple(record.keys())
+            groups.setdefault(keys, []).append([record[k] for k in keys] + [record_id])
+
+        def update_groups(conn):
+            changed = 0
+            for keys, rows in groups.items():
+                set_sql = ", ".join(f"{k} = ?" for k in keys)
+                cursor = conn.executemany(f"UPDATE {table_name} SET {set_sql} WHERE id = ?", rows)
+                changed += cursor.rowcount
+            return changed
+
+        return self._write(update_groups)
+
+    def update_where(self, table_name, conditions: Dict, new_data: Dict):
+        """Update every row matching conditions; returns the number of rows changed."""
+        new_data = self._serialize(table_name, new_data)
+        set_parts = []
+        values = []
+        for k, v in new_data.items():
+            set_parts.append(f"{self._check_column(table_name, k)} = ?")
+            values.append(v)
+
+        where_sql, where_values = self._build_where(table_name, conditions)
+        query = f"UPDATE {table_name} SET {', '.join(set_parts)}{where_sql}"
+
+        return self._write(lambda conn: conn.execute(query, values + where_values).rowcount)
+
+    def increment(self, table_name, conditions: Dict, deltas: Dict[str, int], new_data: Optional[Dict] = None,
+                  advance: Optional[tuple] = None):
+        """
+        Atomically add deltas to counter columns (and optionally set other
+        columns) on every row matching conditions. Returns rows changed.
+
+        advance=(column, value) raises column to MAX(column, value) so it never
+        moves backwards; new_data is then only written where value won.
+        """
+        new_data = self._serialize(table_name, new_data or {})
+        set_parts = []
+        values = []
+        for k, delta in deltas.items():
+            self._check_column(table_name, k)
+            set_parts.append(f"{k} = COALESCE({k}, 0) + ?")
+            values.append(delta)
+        if advance is None:
+            for k, v in new_data.items():
+                set_parts.append(f"{self._check_column(table_name, k)} = ?")
+                values.append(v)
+        else:
+            # Every SET expression sees the old row, so the order does not matter.
+            col, value = advance
+            self._check_column(table_name, col)
+            for k, v in new_data.items():
+                set_parts.append(f"{self._check_column(table_name, k)} = "
+                                 f"CASE WHEN COALESCE({col}, 0) < ? THEN ? ELSE {k} END")
+                values.extend((value, v))
+            set_parts.append(f"{col} = MAX(COALESCE({col}, 0), ?)")
+            values.append(value)
+
+        where_sql, where_values = self._build_where(table_name, conditions)
+        query = f"UPDATE {table_name} SET {', '.join(set_parts)}{where_sql}"
+
+        return self._write(lambda conn: conn.execute(query, values + where_values).rowcount)
 
     def delete(self, table_name, record_id):
-        with self._get_connection() as conn:
-            cursor = conn.execute(f"DELETE FROM {table_name} WHERE id = ?", (record_id,))
-            return cursor.rowcount > 0
+        query = f"DELETE FROM {table_name} WHERE id = ?"
+        return self._write(lambda conn: conn.execute(query, (record_id,)).rowcount) > 0
+
+    SQL_OPERATORS = {'=', '!=', '<>', '<', '<=', '>', '>=', 'LIKE', 'NOT LIKE', 'IN', 'NOT IN'}
 
-    def query(self, table_name, conditions: Dict):
-        query = f"SELECT * FROM {table_name}"
+    def _check_column(self, table_name, col):
+        # Column names are interpolated into SQL, so only declared ones are accepted.
+        columns = self.column_types.get(table_name)
+        if columns is None:
+            valid = IDENTIFIER_RE.match(col) is not None
+        else:
+            valid = col == 'id' or col in columns
+        if not valid:
+            raise ValueError(f"Unknown column '{col}' for table '{table_name}'")
+        return col
+
+    def _build_where(self, table_name, conditions: Dict):
+        """
+        Build a WHERE clause from {col: {op: value}} conditions.
+        'in' / 'not in' take a list of values.
+        """
         where_parts = []
         values = []
-        
+
         for col, cond in conditions.items():
+            self._check_column(table_name, col)
             for op, val in cond.items():
-                sql_op = op
-                if op == '==':
-                    sql_op = '='
-                
-                where_parts.append(f"{col} {sql_op} ?")
-                values.append(val)
-        
-        if where_parts:
-            query += " WHERE " + " AND ".join(where_parts)
-            
+                sql_op = '=' if op == '==' else op.upper()
+                if sql_op not in self.SQL_OPERATORS:
+                    raise ValueError(f"Unsupported operator '{op}'")
+
+                if sql_op in ('IN', 'NOT IN'):
+                    val = list(val)
+                    if not val:
+                        # Empty IN () matches nothing; empty NOT IN () matches everything.
+                        where_parts.append("0" if sql_op == 'IN' else "1")
+                        continue
+                    placeholders = ",".join(["?"] * len(val))
+                    where_parts.append(f"{col} {sql_op} ({placeholders})")
+                    values.extend(val)
+                elif val is None and sql_op in ('=', '!=', '<>'):
+                    where_parts.append(f"{col} IS NULL" if sql_op == '=' else f"{col} IS NOT NULL")
+                else:
+                    where_parts.append(f"{col} {sql_op} ?")
+                    values.append(val)
+
+        if not where_parts:
+            return "", values
+        return " WHERE " + " AND ".join(where_parts), values
+
+    def _build_order(self, table_name, sort_by=None, sort_desc=False, limit=None, offset=None):
+        clause = ""
+        values = []
+        if sort_by:
+            sort_cols = [sort_by] if isinstance(sort_by, str) else list(sort_by)
+            direction = "DESC" if sort_desc else "ASC"
+            clause += " ORDER BY " + ", ".join(
+                f"{self._check_column(table_name, col)} {direction}" for col in sort_cols
+            )
+        if limit is not None or offset:
+            clause += " LIMIT ?"
+            values.append(-1 if limit is None else int(limit))
+            if offset:
+                clause += " OFFSET ?"
+                values.append(int(offset))
+        return clause, values
+
+    def _build_select(self, table_name, columns=None):
+        if not columns:
+            return "*"
+        return ", ".join(self._check_column(table_name, col) for col in columns)
+
+    def delete_many(self, table_name, record_ids):
+        """Delete records by id with chunked 'WHERE id IN (...)'; returns rows deleted."""
+        record_ids = list(record_ids)
+
+        def delete_chunks(conn):
+            deleted = 0
+            for start in range(0, len(record_ids), self.BATCH_SIZE):
+                chunk = record_ids[start:start + self.BATCH_SIZE]
+                placeholders = ",".join(["?"] * len(chunk))
+                cursor = conn.execute(f"DELETE FROM {table_name} WHERE id IN ({placeholders})", chunk)
+                deleted += cursor.rowcount
+            return deleted
+
+        return self._write(delete_chunks)
+
+    def delete_where(self, table_name, conditions: Dict):
+        """Delete every row matching conditions; returns rows deleted."""
+        if not conditions:
+            raise ValueError("delete_where requires at least one condition")
+        where_sql, values = self._build_where(table_name, conditions)
+        query = f"DELETE FROM {table_name}{where_sql}"
+        return self._write(lambda conn: conn.execute(query, values).rowcount)
+
+    def query(self, table_name, conditions: Dict, sort_by=None, sort_desc=False, limit=None, offset=None,
+              columns=None):
+        """
+        Select rows matching conditions.
+
+        sort_by may be a column or a list of columns; limit/offset are
+        applied by SQLite so only the requested page is read. columns
+        restricts the fetched (and deserialized) fields.
+        """
+        select_sql = self._build_select(table_name, columns)
+        where_sql, values = self._build_where(table_name, conditions)
+        order_sql, order_values = self._build_order(table_name, sort_by, sort_desc, limit, offset)
+        query = f"SELECT {select_sql} FROM {table_name}{where_sql}{order_sql}"
+
         with self._get_connection() as conn:
-            cursor = conn.execute(query, values)
+            cursor = conn.execute(query, values + order_values)
             rows = cursor.fetchall()
-            return [self._deserialize(table_name, row) for row in rows]
+            return self._deserialize_rows(table_name, rows)
+
+    def query_last_per_group(self, table_name, group_col, group_values, order_col, per_group, columns=None):
+        """
+        Return the last per_group rows (by order_col) of every group in
+        group_values with one windowed statement, ordered by group then order_col.
+        """
+        group_values = list(group_values)
+        if not group_values:
+            return []
+        self._check_column(table_name, group_col)
+        self._check_column(table_name, order_col)
+        if not columns and table_name in self.column_types:
+            columns = ['id'] + [col for col in self.column_types[table_name] if col != 'id']
+        select_sql = self._build_select(table_name, columns)
+        # The inner SELECT * only feeds the window; the outer one names the columns returned.
+        placeholders = ",".join(["?"] * len(group_values))
+        query = (
+            f"SELECT {select_sql} FROM ("
+            f"SELECT *, ROW_NUMBER() OVER (PARTITION BY {group_col} ORDER BY {order_col} DESC) AS _row_number "
+            f"FROM {table_name} WHERE {group_col} IN ({placeholders})"
+            f") WHERE _row_number <= ? ORDER BY {group_col}, {order_col}"
+        )
+
+        with self._get_connection() as conn:
+            rows = conn.execute(query, group_values + [int(per_group)]).fetchall()
+        return self._deserialize_rows(table_name, rows)
+
+    SEQUENCE_TABLE = 'sequences'
+
+    def create_sequence(self, name, start=0):
+        """
+        Create a named counter if it does not exist yet.
+        start may be a callable, evaluated only when the counter is created.
+        """
+        self.create_table(self.SEQUENCE_TABLE, {
+            'id': 'int',
+            'name': 'str',
+            'value': 'int'
+        }, unique=['name'])
+        if self.exists(self.SEQUENCE_TABLE, {'name': {'==': name}}):
+            return
+        initial = start() if callable(start) else start
+        # OR IGNORE: another worker may have created it in the meantime.
+        query = f"INSERT OR IGNORE INTO {self.SEQUENCE_TABLE} (name, value) VALUES (?, ?)"
+        self._write(lambda conn: conn.execute(query, (name, int(initial or 0))).rowcount)
+
+    def next_sequence_value(self, name):
+        """Increment a counter and return the new value in one write transaction."""
+        def bump(conn):
+            cursor = conn.execute(f"UPDATE {self.SEQUENCE_TABLE} SET value = value + 1 WHERE name = ? "
+                                  "RETURNING value", (name,))
+            row = cursor.fetchone()
+            cursor.close()
+            return row
+
+        row = self._write(bump)
+        if row is None:
+            raise ValueError(f"Sequence '{name}' does not exist")
+        return row[0]
+
+    def current_sequence_value(self, name):
+        return self.aggregate(self.SEQUENCE_TABLE, 'MAX', 'value', {'name': {'==': name}}, default=0)
+
+    AGGREGATES = {'COUNT', 'MAX', 'MIN', 'SUM', 'AVG'}
+
+    def aggregate(self, table_name, func, column='*', conditions: Optional[Dict] = None, default=None):
+        """Run a single SQL aggregate (COUNT/MAX/MIN/SUM/AVG) and return the scalar."""
+        func = func.upper()
+        if func not in self.AGGREGATES:
+            raise ValueError(f"Unsupported aggregate '{func}'")
+        if column != '*':
+            self._check_column(table_name, column)
+        where_sql, values = self._build_where(table_name, conditions or {})
+        query = f"SELECT {func}({column}) FROM {table_name}{where_sql}"
+
+        with self._get_connection() as conn:
+            row = conn.execute(query, values).fetchone()
+        value = row[0] if row else None
+        return default if value is None else value
+
+    def count(self, table_name, conditions: Optional[Dict] = None):
+        return self.aggregate(table_name, 'COUNT', '*', conditions, default=0)
+
+    def exists(self, table_name, conditions: Optional[Dict] = None):
+        where_sql, values = self._build_where(table_name, conditions or {})
+        query = f"SELECT 1 FROM {table_name}{where_sql} LIMIT 1"
+
+        with self._get_connection() as conn:
+            return conn.execute(query, values).fetchone() is not None
+
+    def max(self, table_name, column, conditions: Optional[Dict] = None, default=None):
+        return self.aggregate(table_name, 'MAX', column, conditions, default=default)
+
+    def min(self, table_name, column, conditions: Optional[Dict] = None, default=None):
+        return self.aggregate(table_name, 'MIN', column, conditions, default=default)
+
+
+class VersionCounter:
+    """
+    Sequence-backed version number for data that workers cache in memory.
+    Writers call bump(); current() only reads the counter when another
+    connection has committed to the database since it was last read through
+    the same pooled connection (see SQLiteHandler.data_version), so an
+    unchanged version costs no reads.
+    """
+
+    def __init__(self, db: SQLiteHandler, name):
+        self.db = db
+        self.name = name
+        self._checked = {}  # {connection: (data_version, version)}
+        self._lock = threading.Lock()
+
+    def _remember(self, conn, data_version, version):
+        with self._lock:
+            checked = self._checked.get(conn)
+            if checked is None or checked[1] < version:
+                self._checked[conn] = (data_version, version)
+
+    def bump(self):
+        # Taken before the write: conn's own commits do not move its data
+        # version, anyone else's in between makes current() read again.
+        with self.db.connection() as conn:
+            data_version = self.db.data_version(conn)
+        version = self.db.next_sequence_value(self.name)
+        # Inside a transaction(), only a committed version may be remembered;
+        # after a rollback current() keeps the last committed one.
+        self.db.on_commit(lambda: self._remember(conn, data_version, version))
+        return version
+
+    def current(self):
+        # Checked out once: no other thread commits through conn meanwhile.
+        with self.db.connection() as conn:
+            data_version = self.db.data_version(conn)
+            with self._lock:
+                checked = self._checked.get(conn)
+            if checked is None or checked[0] != data_version:
+                row = conn.execute(f"SELECT value FROM {self.db.SEQUENCE_TABLE} WHERE name = ?",
+                                   (self.name,)).fetchone()
+                checked = (data_version, row[0] if row else 0)
+                with self._lock:
+                    self._checked[conn] = checked
+        return checked[1]
 
 
 class SQLiteConfig:
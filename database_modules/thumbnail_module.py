@@ -0,0 +1,142 @@
+"""
+Imageboard Image Thumbnails.
+Every uploaded image gets thumbnails at ingest, in THUMB_SIZES (longest side,
+in px) and in WebP plus a JPEG fallback, next to the video thumbnails:
+    static/post_images/thumbs/<filename>_<size>.webp / .jpg
+    static/reply_images/thumbs/<filename>_<size>.webp / .jpg
+named after the full stored filename, which is unique in its folder (x.png
+and x.jpg get separate thumbnails).
+Board and catalog pages show them through thumbnail(); images uploaded before
+thumbnails existed fall back to the full file until `python -m
+database_modules.thumbnail_module` backfills them.
+"""
+
+import os
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageOps
+
+THUMB_SIZES = (200, 400)  # 1x and 2x of the ~200px board/catalog previews
+THUMB_FORMATS = (
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+    ('jpg', 'JPEG', {'quality': 80, 'optimize': True, 'progressive': True})
+)
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif', '.webp')
+MEDIA_FOLDERS = ('post_images', 'reply_images')
+STATIC_DIR = './static'
+LOOKUP_CACHE_SIZE = 4096
+
+_lookups = OrderedDict()  # {(folder, filename): thumbnail() URLs}, least recently used first
+_lookups_lock = threading.Lock()
+
+def thumb_filename(filename, size, ext):
+    return f"{filename}_{size}.{ext}"
+
+def thumb_folder(folder):
+    return os.path.join(STATIC_DIR, folder, 'thumbs')
+
+def make_thumbnails(img, filename, folder_path, info=None):
+    """
+    Write every size and format of the thumbnails of a PIL image that was
+    saved as filename; folder_path is its thumbs folder. Returns the paths.
+    info is the image's original info dict, if it was cleared to strip metadata.
+    """
+    os.makedirs(folder_path, exist_ok=True)
+    info = img.info if info is None else info
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        if 'transparency' in info and 'transparency' not in img.info:
+            # convert() reads the transparent colour from img.info.
+            img = img.copy()
+            img.info['transparency'] = info['transparency']
+        img = img.convert('RGBA' if 'transparency' in info or img.mode in ('LA', 'PA') else 'RGB')
+    paths = []
+    # Largest first, so each smaller size is reduced from the previous one.
+    for size in sorted(THUMB_SIZES, reverse=True):
+        img = img.copy()
+        img.thumbnail((size, size), Image.LANCZOS, reducing_gap=3.0)
+        flat = img
+        if img.mode == 'RGBA':
+            # JPEG has no alpha: flatten onto white.
+            flat = Image.new('RGB', img.size, 'white')
+            flat.paste(img, mask=img.getchannel('A'))
+        for ext, image_format, options in THUMB_FORMATS:
+            path = os.path.join(folder_path, thumb_filename(filename, size, ext))
+            (img if image_format == 'WEBP' else flat).save(path, format=image_format, **options)
+            paths.append(path)
+    forget(os.path.basename(os.path.dirname(os.path.normpath(folder_path))), filename)
+    return paths
+
+def delete_thumbnails(base_path, filename):
+    """Remove the image thumbnails of filename stored under base_path/thumbs."""
+    for size in THUMB_SIZES:
+        for ext, _, _ in THUMB_FORMATS:
+            path = os.path.join(base_path, 'thumbs', thumb_filename(filename, size, ext))
+            if os.path.exists(path):
+                os.remove(path)
+    forget(os.path.basename(os.path.normpath(base_path)), filename)
+
+def forget(folder, filename):
+    with _lookups_lock:
+        _lookups.pop((folder, filename), None)
+
+def _lookup(folder, filename):
+    if not filename.lower().endswith(IMAGE_EXTENSIONS):
+        return None
+    smallest = min(THUMB_SIZES)
+    if not os.path.exists(os.path.join(thumb_folder(folder), thumb_filename(filename, smallest, 'jpg'))):
+        return None
+    base_url = f"/static/{folder}/thumbs/"
+
+    def srcset(ext):
+        return ', '.join(f"{base_url}{thumb_filename(filename, size, ext)} {size // smallest}x"
+                         for size in sorted(THUMB_SIZES))
+
+    return {
+        'src': base_url + thumb_filename(filename, smallest, 'jpg'),
+        'jpg_srcset': srcset('jpg'),
+        'webp_srcset': srcset('webp')
+    }
+
+def thumbnail(folder, filename):
+    """
+    {'src', 'jpg_srcset', 'webp_srcset'} URLs of the thumbnails of an image in
+    static/<folder>/, or None if it has none (videos, embeds, animated GIFs,
+    older uploads). Found thumbnails are cached per process; misses are not,
+    so thumbnails made later by an upload or backfill() show up.
+    """
+    key = (folder, filename)
+    with _lookups_lock:
+        if key in _lookups:
+            _lookups.move_to_end(key)
+            return _lookups[key]
+    result = _lookup(folder, filename)
+    if result is None:
+        return None
+    with _lookups_lock:
+        _lookups[key] = result
+        if len(_lookups) > LOOKUP_CACHE_SIZE:
+            _lookups.popitem(last=False)
+    return result
+
+def backfill():
+    """Create the missing thumbnails of images uploaded before thumbnails existed."""
+    created = 0
+    for folder in MEDIA_FOLDERS:
+        media_path = os.path.join(STATIC_DIR, folder)
+        if not os.path.isdir(media_path):
+            continue
+        for filename in sorted(os.listdir(media_path)):
+            if not filename.lower().endswith(IMAGE_EXTENSIONS) or thumbnail(folder, filename):
+                continue
+            try:
+                with Image.open(os.path.join(media_path, filename)) as img:
+                    if getattr(img, 'is_animated', False):
+                        continue
+                    make_thumbnails(ImageOps.exif_transpose(img), filename, thumb_folder(folder))
+                created += 1
+            except Exception as e:
+                print(f"Error generating thumbnails for {filename}: {e}")
+    print(f"Generated thumbnails for {created} images.")
+
+if __name__ == '__main__':
+    backfill()
@@ -19,16 +19,17 @@ document.addEventListener('click', function(event) {
     // Esconde a imagem original
     img.style.display = 'none';
 
-    // Cria a versão expandida
+    // Cria a versão expandida (arquivo completo, não a miniatura)
     const expandedImg = document.createElement('img');
     expandedImg.classList.add(img.classList.contains('post_img') ? 'post_img_resized' : 'reply_img_resized');
-    expandedImg.src = img.src;
+    expandedImg.src = img.dataset.full || img.src;
     expandedImg.alt = img.alt;
     expandedImg.style.cursor = 'pointer';
     expandedImg.style.maxWidth = "100%";
 
-    // Insere após a imagem original
-    img.parentNode.insertBefore(expandedImg, img.nextSibling);
+    // Insere após a imagem original (ou após o <picture> da miniatura)
+    const anchor = img.parentNode.tagName === 'PICTURE' ? img.parentNode : img;
+    anchor.parentNode.insertBefore(expandedImg, anchor.nextSibling);
 
     // Adiciona evento para fechar a imagem expandida
     expandedImg.addEventListener('click', function(e) {
@@ -0,0 +1,12 @@
+"""
+database_module opens ./databases/*.db and migrates them on import, so the
+tests run from a scratch directory and never touch the real databases.
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(tempfile.mkdtemp(prefix='rchan-tests-'))
@@ -0,0 +1,55 @@
+import time
+
+from database_modules import database_module as dm
+
+
+def issue(nonce=None):
+    nonce = nonce or dm.secrets.token_urlsafe(12)
+    return dm.captcha_answer(nonce), dm.hash_captcha(dm.captcha_answer(nonce), nonce)
+
+
+def test_token_is_accepted_once():
+    answer, token = issue()
+    assert dm.validate_captcha(answer, token)
+    assert not dm.validate_captcha(answer, token)
+
+
+def test_wrong_answer_does_not_consume_the_token():
+    answer, token = issue()
+    assert not dm.validate_captcha('wrong!', token)
+    assert dm.validate_captcha(answer, token)
+
+
+def test_expired_token_is_rejected():
+    nonce = 'expired-nonce'
+    answer = dm.captcha_answer(nonce)
+    expires = int(time.time()) - 1
+    token = f"{expires}.{nonce}.{dm._captcha_mac(expires, nonce, answer)}"
+    assert not dm.validate_captcha(answer, token)
+
+
+def test_token_expires_after_ttl(monkeypatch):
+    answer, token = issue()
+    later = time.time() + dm.CAPTCHA_TOKEN_TTL + 1
+    monkeypatch.setattr(dm.time, 'time', lambda: later)
+    assert not dm.validate_captcha(answer, token)
+
+
+def test_extended_expiry_breaks_the_signature():
+    answer, token = issue()
+    expires, nonce, mac = token.split('.')
+    forged = f"{int(expires) + 3600}.{nonce}.{mac}"
+    assert not dm.validate_captcha(answer, forged)
+
+
+def test_malformed_tokens_are_rejected():
+    for token in ('', 'abc', 'x.y.z', '1.2', None):
+        assert not dm.validate_captcha('answer', token)
+
+
+def test_expired_nonces_are_pruned():
+    answer, token = issue('pruned-nonce')
+    assert dm.validate_captcha(answer, token)
+    assert dm.DB.exists('captcha_used', {'nonce': {'==': 'pruned-nonce'}})
+    dm._claim_captcha_nonce('other-nonce', time.time() + 60, time.time() + dm.CAPTCHA_TOKEN_TTL + 1)
+    assert not dm.DB.exists('captcha_used', {'nonce': {'==': 'pruned-nonce'}})
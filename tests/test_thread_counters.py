@@ -0,0 +1,78 @@
+import itertools
+import threading
+
+import pytest
+
+from database_modules import database_module as dm
+
+WORKERS = 8
+REPLIES_PER_WORKER = 10
+_boards = itertools.count()
+
+
+@pytest.fixture(params=[False, True], ids=['direct', 'single_writer'])
+def thread_id(request, monkeypatch):
+    monkeypatch.setattr(dm.DB, 'single_writer', request.param)
+    monkeypatch.setattr(dm, 'validate_captcha', lambda captcha_input, captcha_text: True)
+    board_uri = f"counters{next(_boards)}"
+    dm.register_user('counters', 'password123', '', '')
+    assert dm.add_new_board(board_uri, 'Counters', 'counter tests', 'counters', '', '')
+    return dm.add_new_post('127.0.0.1', '', board_uri, 'thread', 'Anon', 'op', 'op', '', [])
+
+
+def reply(thread_id, n):
+    # Reserve the number first, like PostHandler, so commits arrive out of order.
+    reply_id = dm.next_post_id()
+    files = [f"{reply_id}.png"] * (n % 3)
+    subject = 'sage' if n % 4 == 0 else ''
+    dm.add_new_reply('127.0.0.1', '', subject, thread_id, 'Anon', f"reply {n}", '', files, reply_id=reply_id)
+
+
+def test_concurrent_replies_keep_counters_consistent(thread_id):
+    errors = []
+
+    def worker():
+        try:
+            for n in range(REPLIES_PER_WORKER):
+                reply(thread_id, n)
+        except Exception as e:  # Surfaced below; a thread cannot fail the test itself.
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+    post = dm.DB.query('posts', {'post_id': {'==': thread_id}})[0]
+    stored = {column: post[column] for column in ('reply_count', 'image_count', 'last_reply_id', 'last_reply_at')}
+    assert stored['reply_count'] == WORKERS * REPLIES_PER_WORKER
+    assert stored == dm.refresh_thread_stats(thread_id)
+
+    board_uri = post['board']
+    stats = dm.get_all_board_stats()[board_uri]
+    assert stats['reply_count'] == WORKERS * REPLIES_PER_WORKER
+    assert stats['last_post_id'] == stored['last_reply_id']
+    recomputed = dm.refresh_board_stats(board_uri)
+    assert (stats['thread_count'], stats['reply_count'], stats['last_post_id']) == \
+        (recomputed['thread_count'], recomputed['reply_count'], recomputed['last_post_id'])
+
+
+def test_bump_sequence_stays_unique(thread_id):
+    for n in range(1, 6):
+        reply(thread_id, n)
+    bumps = [post['bumped_at'] for post in dm.DB.find_all('posts', columns=['bumped_at'])]
+    assert len(bumps) == len(set(bumps))
+    assert max(bumps) == dm.DB.current_sequence_value(dm.BUMP_SEQUENCE)
+
+
+def test_late_commit_of_an_older_reply_keeps_the_newest(thread_id):
+    older, newer = dm.next_post_id(), dm.next_post_id()
+    dm.add_new_reply('127.0.0.1', '', '', thread_id, 'Anon', 'newer', '', [], reply_id=newer)
+    newest_at = dm.DB.query('posts', {'post_id': {'==': thread_id}})[0]['last_reply_at']
+    dm.add_new_reply('127.0.0.1', '', '', thread_id, 'Anon', 'older', '', [], reply_id=older)
+
+    post = dm.DB.query('posts', {'post_id': {'==': thread_id}})[0]
+    assert (post['last_reply_id'], post['last_reply_at']) == (newer, newest_at)
+    assert dm.get_all_board_stats()[post['board']]['last_post_id'] == newer